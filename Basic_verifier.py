@@ -1,14 +1,108 @@
+from ecdsa import SigningKey, VerifyingKey, NIST384p, BadSignatureError
+import pandas as pd
+import json
+import hashlib
+from flask import Flask, jsonify, request
+import requests
+from uuid import uuid4
+import merkle
 
-from ecdsa import SigningKey, NIST384p
-sk = SigningKey.generate(curve=NIST384p)
-sk2 = SigningKey.generate(curve=NIST384p)
-vk = sk.verifying_key
-print(sk.to_string().encode('hex'))
-print(sk2.to_string().encode('hex'))
-msg = "vote to a"
-si = sk.sign(msg)
-nmsg = "vote to da"
-try:
-    assert vk.verify(si, nmsg)
-except:
-    print("Bad sign")
+# Node the light client asks for inclusion proofs
+NODE_ADDRESS = "http://localhost:5000"
+
+
+class User:
+
+    def __init__(self, name, mail_id):
+        self.name = name
+        self.Email_id = mail_id
+        self.assign_keys()
+
+    def assign_keys(self):
+        sk = SigningKey.generate(curve=NIST384p)
+        self.private_key = sk
+        self.public_key = sk.verifying_key
+
+    def print_keys(self):
+        print(self.private_key.to_string().hex())
+        print(self.public_key.to_string().hex())
+
+
+# Only the nodes' public key: the light client never loads their signing key
+with open("verifying_key_block.pem", "rb") as f:
+    vk_block = VerifyingKey.from_pem(f.read())
+
+
+def is_valid_header(block):
+    # The block hash and signature cover the header fields only
+    header = {
+        "index": block["index"],
+        "timestamp": block["timestamp"],
+        "previous_hash": block["previous_hash"],
+        "merkle_root": block["merkle_root"]
+    }
+    encoded_header = json.dumps(header, sort_keys=True).encode()
+    if "hash" in block and block["hash"] != hashlib.sha256(encoded_header).hexdigest():
+        return False
+    try:
+        return vk_block.verify(bytes.fromhex(block["proof_of_verification"]), encoded_header)
+    except (BadSignatureError, ValueError, TypeError):
+        return False
+
+
+def verify_inclusion(transaction_id, proof, pub_key=None, vote=None):
+    # Light verification: only the signed block header and the Merkle path
+    # are checked, the rest of the block and chain is never downloaded.
+    if "error" in proof or proof.get("transaction_id") != transaction_id:
+        return False
+    transaction = proof["transaction"]
+    if pub_key is not None and transaction["pub_key"] != pub_key:
+        return False
+    if vote is not None and transaction["vote"] != vote:
+        return False
+    block = proof["block"]
+    if not is_valid_header(block):
+        return False
+    return merkle.verify_path(transaction_id, transaction, proof["path"], block["merkle_root"])
+
+
+data = pd.read_excel("voterlist.xlsx")
+name = data['Name'].iloc
+mail_id = data['Email'].iloc
+vote = data['vote'].iloc
+
+
+user = []
+for i in range(len(data['Name'])):
+    u = User(name[i], mail_id[i])
+    user.append(u)
+
+total_vote_sent = 0
+app = Flask(__name__)
+i = 0
+
+
+@app.route('/send_vote', methods=['GET'])
+def send_vote():
+    sk = user[i].private_key
+    sign = sk.sign(vote[i].encode())
+    txn = {'pub_key': user[i].public_key.to_string().hex(),
+           'sign': sign.hex(),
+           'vote': vote[i]
+           }
+    return json.dumps(dict(txn)), 200
+
+
+@app.route('/verify_vote/<transaction_id>', methods=['GET'])
+def verify_vote(transaction_id):
+    proof = requests.get(NODE_ADDRESS + '/proof/' + transaction_id).json()
+    included = verify_inclusion(transaction_id, proof, pub_key=request.args.get('pub_key'))
+    response = {'transaction_id': transaction_id, 'included': included}
+    if included:
+        response['block_index'] = proof['block']['index']
+        response['block_hash'] = proof['block']['hash']
+    return json.dumps(response), 200
+
+
+app.run(host='0.0.0.0', port=5005, debug=True)
+# send_vote()
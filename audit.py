@@ -0,0 +1,208 @@
+import sys
+import numpy as np
+from transaction_table import TransactionTable, vote_column, pub_key_column, timestamp_column
+
+# Columnar export of the chain for audits: one array entry per vote, so
+# recounts and anomaly checks run as NumPy operations instead of walking
+# nested block dicts.
+
+OUTLIER_THRESHOLD = 6.0
+REPORT_LIMIT = 20
+
+
+def _field(block, name):
+    return block[name] if isinstance(block, dict) else getattr(block, name)
+
+
+def _raw_pub_keys(blocks):
+    # Every vote's key as one row of raw bytes, read straight from the packed
+    # tables; None if some key has no exact fixed-width raw form
+    parts, width = [], None
+    for transactions in blocks:
+        if isinstance(transactions, TransactionTable):
+            raw, key_width = transactions.packed_pub_keys()
+        else:
+            pub_keys = list(pub_key_column(transactions))
+            try:
+                keys = [bytes.fromhex(pub_key) for pub_key in pub_keys]
+            except (TypeError, ValueError):
+                return None
+            key_width = len(keys[0]) if keys else 0
+            if any(len(key) != key_width or key.hex() != pub_key for key, pub_key in zip(keys, pub_keys)):
+                return None
+            raw = b''.join(keys)
+        if not raw:
+            continue
+        if width not in (None, key_width):
+            return None
+        width = key_width
+        parts.append(raw)
+    if width is None or width < 8:
+        return None
+    return np.frombuffer(b''.join(parts), dtype=np.uint8).reshape(-1, width)
+
+
+def _unique_rows(rows):
+    # Sorts on the first eight bytes of each row and checks that rows sharing
+    # them are equal, falling back to whole rows if two keys collide
+    prefix = np.ascontiguousarray(rows[:, :8]).view('<u8').ravel()
+    _, first, inverse = np.unique(prefix, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    if not (rows == rows[first[inverse]]).all():
+        whole = np.ascontiguousarray(rows).view('V%d' % rows.shape[1]).ravel()
+        _, first, inverse = np.unique(whole, return_index=True, return_inverse=True)
+    return first, inverse.ravel()
+
+
+def _first_seen(first, inverse):
+    # Renumbers unique values in order of first appearance, as if codes were
+    # handed out walking the chain; returns the codes and the unique values' order
+    order = np.argsort(first, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank[inverse], order
+
+
+def _hex_rows(rows):
+    # One hex conversion for all rows, then cut into a string per row
+    text = rows.tobytes().hex()
+    step = 2 * rows.shape[1]
+    names = np.empty(len(rows), dtype=object)
+    names[:] = [text[start:start + step] for start in range(0, len(text), step)]
+    return names
+
+
+def _codes(values):
+    names, first, inverse = np.unique(values, return_index=True, return_inverse=True)
+    codes, order = _first_seen(first, inverse.ravel())
+    return codes, names[order].astype(object)
+
+
+def _timestamps(transactions):
+    if isinstance(transactions, TransactionTable):
+        return np.frombuffer(transactions.timestamps(), dtype=np.float64)
+    timestamps = []
+    for value in timestamp_column(transactions):
+        try:
+            timestamps.append(float(value))
+        except (TypeError, ValueError):
+            timestamps.append(float('nan'))
+    return np.array(timestamps, dtype=np.float64)
+
+
+def export_columns(chain):
+    # Blocks can be Block objects or plain dicts as stored on disk
+    blocks, votes, timestamps = [], [], []
+    block_index, block_size, block_timestamp = [], [], []
+    for block in chain:
+        transactions = _field(block, "transactions")
+        blocks.append(transactions)
+        block_index.append(_field(block, "index"))
+        block_size.append(len(transactions))
+        block_timestamp.append(float(_field(block, "timestamp")))
+        votes.extend(vote_column(transactions))
+        timestamps.append(_timestamps(transactions))
+
+    # Few distinct candidates, so they are numbered through a dict at C speed
+    candidate_codes = {name: code for code, name in enumerate(dict.fromkeys(votes))}
+    candidate = np.fromiter(map(candidate_codes.__getitem__, votes), dtype=np.int32, count=len(votes))
+    candidates = np.array(list(candidate_codes), dtype=object)
+    raw_keys = _raw_pub_keys(blocks)
+    if raw_keys is not None:
+        first, inverse = _unique_rows(raw_keys)
+        voter, order = _first_seen(first, inverse)
+        voters = _hex_rows(raw_keys[first[order]])
+    else:
+        voter, voters = _codes(np.array([pub_key for transactions in blocks
+                                         for pub_key in pub_key_column(transactions)], dtype=str))
+    return {
+        "candidate": candidate,
+        "voter": voter,
+        "block": np.repeat(np.array(block_index, dtype=np.int64), block_size),
+        "timestamp": np.concatenate(timestamps) if timestamps else np.array([], dtype=np.float64),
+        "block_timestamp": np.array(block_timestamp, dtype=np.float64),
+        "candidates": candidates,
+        "voters": voters,
+    }
+
+
+def save_columns(path, columns):
+    np.savez_compressed(path, **columns)
+
+
+def load_columns(path):
+    with np.load(path, allow_pickle=True) as data:
+        return {name: data[name] for name in data.files}
+
+
+def recount(columns):
+    totals = np.bincount(columns["candidate"], minlength=len(columns["candidates"]))
+    return {str(name): int(count) for name, count in zip(columns["candidates"], totals)}
+
+
+def votes_per_block(columns):
+    return np.bincount(columns["block"], minlength=len(columns["block_timestamp"]))
+
+
+def timestamp_outliers(columns, threshold=OUTLIER_THRESHOLD):
+    # Time from a vote's own timestamp to the block that sealed it, scored
+    # with a median/MAD z-score so a handful of bad clocks cannot hide.
+    # Votes stamped after their block, or without a usable time, always count.
+    delay = columns["block_timestamp"][columns["block"]] - columns["timestamp"]
+    known = ~np.isnan(delay)
+    flagged = ~known | (delay < 0)
+    if known.any():
+        median = np.median(delay[known])
+        mad = np.median(np.abs(delay[known] - median))
+        if mad > 0:
+            score = np.zeros_like(delay)
+            score[known] = 0.6745 * (delay[known] - median) / mad
+            flagged |= np.abs(score) > threshold
+    return np.flatnonzero(flagged)
+
+
+def duplicate_voters(columns):
+    counts = np.bincount(columns["voter"], minlength=len(columns["voters"]))
+    return np.flatnonzero(counts > 1), counts
+
+
+def report(columns):
+    totals = recount(columns)
+    per_block = votes_per_block(columns)
+    outliers = timestamp_outliers(columns)
+    duplicates, voter_counts = duplicate_voters(columns)
+    result = {
+        "total_votes": int(len(columns["candidate"])),
+        "counts": totals,
+        "votes_per_block": {
+            "blocks": int(len(per_block)),
+            "min": int(per_block.min()) if len(per_block) else 0,
+            "max": int(per_block.max()) if len(per_block) else 0,
+            "mean": float(per_block.mean()) if len(per_block) else 0.0,
+            "empty_blocks": int(np.count_nonzero(per_block[1:] == 0)),
+        },
+        "timestamp_outliers": {
+            "count": int(len(outliers)),
+            "examples": [{"block": int(columns["block"][i]),
+                          "timestamp": None if np.isnan(columns["timestamp"][i]) else float(columns["timestamp"][i]),
+                          "block_timestamp": float(columns["block_timestamp"][columns["block"][i]])}
+                         for i in outliers[:REPORT_LIMIT]],
+        },
+        "duplicate_voters": {
+            "count": int(len(duplicates)),
+            "examples": [{"pub_key": str(columns["voters"][i]), "votes": int(voter_counts[i])}
+                         for i in duplicates[:REPORT_LIMIT]],
+        },
+    }
+    return result
+
+
+if __name__ == '__main__':
+    # Usage: python audit.py <block store directory> [columns.npz]
+    import json
+    from block_store import BlockStore
+    store = BlockStore(sys.argv[1], decode=lambda block_data: block_data, readonly=True)
+    columns = export_columns(store)
+    if len(sys.argv) > 2:
+        save_columns(sys.argv[2], columns)
+    print(json.dumps(report(columns), indent=2))
@@ -1,59 +1,193 @@
 import datetime
 import hashlib
+import hmac
 import json
-from flask import Flask, jsonify, request
+import math
+from flask import Flask, Response, g, jsonify, request
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from uuid import uuid4
-from hashlib import sha256
 import time
 import utils
+import merkle
+import struct
 import sys
+import os
+import threading
+from block_store import BlockStore
+from block_fetch import BlockFetcher, OrphanBuffer
+from broadcast import Broadcaster
+from inventory import InventoryBatcher
+from mempool import Mempool
+from spent_index import SpentIndex, PENDING
+from chain_index import ChainIndex
+from scheduler import BlockScheduler, InclusionStats, proposer_for
+from shared_state import SharedState, MirroredDict, MirroredSet, SharedDict, SharedSet, SharedPool
+import iblt
+import wire
+import audit
+import metrics
+import profiling
+import tracing
+from election import Tally
+from transaction_table import compact, pub_key_column
 
 class Block:
-    def __init__(self, index, transactions, proof_of_verification, timestamp, previous_hash):
+    # Slots and packed transactions keep long in-memory chains small
+    __slots__ = ('index', 'transactions', 'proof_of_verification', 'timestamp', 'previous_hash', 'merkle_root', 'hash')
+    FIELDS = __slots__
+
+    def __init__(self, index, transactions, proof_of_verification, timestamp, previous_hash, merkle_root=None):
         self.index = index
-        self.transactions = transactions
         self.proof_of_verification = proof_of_verification
         self.timestamp = timestamp
         self.previous_hash = previous_hash # Adding the previous hash field
+        if merkle_root is None:
+            merkle_root = merkle.merkle_root(transactions)
+        self.merkle_root = merkle_root
+        self.transactions = compact(transactions)
+
+    @classmethod
+    def from_dict(cls, block_data):
+        block = cls(block_data["index"],
+                    block_data["transactions"],
+                    block_data["proof_of_verification"],
+                    block_data["timestamp"],
+                    block_data["previous_hash"],
+                    block_data.get("merkle_root"))
+        block.hash = block_data["hash"]
+        return block
+
+    def to_dict(self):
+        # The JSON shape blocks always had, built only when a block is sent or stored
+        block_data = {}
+        for field in self.FIELDS:
+            if hasattr(self, field):
+                block_data[field] = getattr(self, field)
+        block_data["transactions"] = dict(self.transactions.items())
+        return block_data
+
+    def header(self):
+        return utils.block_header(self.index, self.timestamp, self.previous_hash, self.merkle_root)
 
     def compute_hash(self):
-        block_string = json.dumps(self.__dict__, sort_keys=True) # The string equivalent also considers the previous_hash field now
-        return sha256(block_string.encode()).hexdigest()
+        # Only the header is hashed, the transactions are covered by merkle_root
+        return utils.hash_header(self.header())
     
     
 
 class Blockchain:
 
-    def __init__(self, PORT):
-        self.chain = []
-        self.transactions = {}
+    def __init__(self, PORT, store=None):
+        # With a store the chain lives on disk, otherwise in a plain list
+        self.store = store
+        self.chain = store if store is not None else []
+        self.transactions = Mempool(max_count=MEMPOOL_MAX_TXNS, max_bytes=MEMPOOL_MAX_BYTES, evict=MEMPOOL_EVICT)
         self.peers = set()
         self.PORT = PORT
-        self.sequence_number = 1
+        self.sequence_number = store.sequence_number + 1 if store is not None else 1
         self.encrypted_transactions = {}
         self.pending_blocks = {}
         self.pending_blocks_counts = {}
         self.received_block_advertises = set()
+        self.orphans = OrphanBuffer(ORPHAN_MAX_BLOCKS)
+        self.tally = self.load_tally()
+        self.inclusion = InclusionStats()
+        # Held while the chain or the pool changes shape: sealing, appending,
+        # truncating and admitting votes
+        self.lock = threading.RLock()
+        self.load_indexes()
+
+    def load_tally(self):
+        if self.store is None:
+            return Tally()
+        # Resume from the last snapshot if it still describes a prefix of the
+        # stored chain, then apply whatever was appended after it
+        tally = Tally.load(os.path.join(self.store.path, "tally.json"))
+        if tally.height > len(self.chain) or (tally.height and self.chain[tally.height - 1].hash != tally.tip):
+            tally = Tally()
+        for index in range(tally.height, len(self.chain)):
+            tally.apply_block(self.chain[index])
+        return tally
+
+    def save_tally(self):
+        if self.store is not None:
+            self.tally.save(os.path.join(self.store.path, "tally.json"))
+
+    def load_indexes(self):
+        # Like the tally, the spent and chain indexes resume from their last
+        # snapshot if it still describes a prefix of the stored chain, and
+        # only the blocks appended after it are indexed again
+        self.spent = SpentIndex()
+        self.index = ChainIndex(track_hashes=self.store is None)
+        height = 0
+        if self.store is not None:
+            try:
+                spent, spent_height, spent_tip = SpentIndex.load(os.path.join(self.store.path, "spent.idx"))
+                index, index_height, index_tip = ChainIndex.load(os.path.join(self.store.path, "chain_index.json"))
+            except (OSError, ValueError, KeyError, struct.error):
+                pass
+            else:
+                if ((spent_height, spent_tip) == (index_height, index_tip) and 0 < spent_height <= len(self.chain)
+                        and self.store.hash_at(spent_height - 1) == spent_tip):
+                    self.spent, self.index, height = spent, index, spent_height
+        for index in range(height, len(self.chain)):
+            self.index_block(self.chain[index])
+
+    def save_indexes(self):
+        # The snapshots are copied here, under the lock, and written to disk
+        # by the snapshot writer so appends do not wait on the writes
+        if self.store is not None and self.chain:
+            height, tip = len(self.chain), self.last_block.hash
+            spent = self.spent.snapshot(height, tip)
+            index = self.index.snapshot(height, tip)
+            snapshot_writer.submit(self.write_indexes, self.store.path, spent, index)
+
+    @staticmethod
+    def write_indexes(path, spent, index):
+        try:
+            SpentIndex.write(os.path.join(path, "spent.idx"), spent)
+            ChainIndex.write(os.path.join(path, "chain_index.json"), index)
+        except OSError:
+            app.logger.exception("Could not save the index snapshots")
+
+    def save_snapshots(self, length):
+        # For blocks appended without saving, like a page during a sync: the
+        # tally once for all of them, the indexes if an interval was crossed
+        self.save_tally()
+        if len(self.chain) // INDEX_SNAPSHOT_INTERVAL > length // INDEX_SNAPSHOT_INTERVAL:
+            self.save_indexes()
+
+    def index_block(self, block):
+        for pub_key in pub_key_column(block.transactions):
+            self.spent.mark_committed(pub_key, block.index)
+        self.index.add(block)
+
+    def append_block(self, block, save=True):
+        self.chain.append(block)
+        self.tally.apply_block(block)
+        self.index_block(block)
+        # Pooled votes leave the pool only once a block holding them is on
+        # the chain, so a fetched block that never connects costs no votes
+        if self.transactions:
+            self.remove_included(block.transactions)
+        if save:
+            self.save_tally()
+            if len(self.chain) % INDEX_SNAPSHOT_INTERVAL == 0:
+                self.save_indexes()
 
     def create_genesis_block(self):
-        block = {
-                "index" : 0,
-                "transactions" : {},
-                "timestamp" : time.time(),
-                "previous_hash" : 0
-            }
-        sign = utils.sign_block(block["index"], block["transactions"], block["timestamp"], block["previous_hash"])
         genesis_block = Block(
-                index = block["index"],
-                transactions = block["transactions"],
-                proof_of_verification = sign,
-                timestamp = block["timestamp"],
-                previous_hash = block["previous_hash"]
+                index = 0,
+                transactions = {},
+                proof_of_verification = None,
+                timestamp = time.time(),
+                previous_hash = 0
             )
+        genesis_block.proof_of_verification = utils.sign_header(genesis_block.header())
         genesis_block.hash = genesis_block.compute_hash()
-        self.chain.append(genesis_block)
-        return genesis_block.__dict__
+        self.append_block(genesis_block)
+        return genesis_block.to_dict()
 
     @property
     def last_block(self):
@@ -62,6 +196,8 @@ class Blockchain:
     def add_new_transaction(self, tx_data):
         transaction_id = str(self.PORT) + str(self.sequence_number)
         self.sequence_number +=1
+        if self.store is not None:
+            self.store.sequence_number = self.sequence_number - 1
         txn = {
                 "pub_key" : tx_data["pub_key"],
                 "vote" : tx_data["vote"],
@@ -74,104 +210,309 @@ class Blockchain:
         
         return transaction_id
     
-    def add_block(self, block, clone_mode=False):
-        if(block.previous_hash != self.last_block.hash):
-            return False
+    def add_block(self, block, clone_mode=False, verified=False):
+        with self.lock:
+            if(block.previous_hash != self.last_block.hash):
+                return False
             
-        if not utils.is_valid_block(block.__dict__):
-            return False
-        
-        if block.index <= self.last_block.index:
-            return True
+            if not verified and not utils.is_valid_block(block.to_dict()):
+                return False
         
-        self.chain.append(block)
-        if clone_mode:
-            return True
+            if block.index <= self.last_block.index:
+                return True
         
-        next_index = block.index + 1
+            # A sync saves the tally and indexes once per page
+            self.append_block(block, save=not clone_mode)
+            if clone_mode:
+                return True
         
-        while next_index in self.pending_blocks_counts:
-            if(self.pending_blocks_counts[next_index] >= (len(self.peers) + 1) //2):
-                self.chain.append(block)
-                next_index +=1
-            else:
-                break
-        return True
+            self._connect_waiting()
+            return True
+
+    def _connect_waiting(self):
+        # Connect blocks that were waiting on the tip: pending blocks that
+        # already reached consensus on top of it and orphans whose parent it is
+        while True:
+            tip = self.last_block
+            pending = self.pending_blocks.get(tip.index + 1)
+            if (pending is not None and pending.previous_hash == tip.hash
+                    and self.pending_blocks_counts.get(tip.index + 1, 0) >= (len(self.peers) + 1) //2):
+                self.append_block(self.pending_blocks.pop(tip.index + 1))
+                continue
+            orphan = self.orphans.take(tip.hash)
+            if orphan is None:
+                return
+            self.append_block(orphan)
+
+    def connect_block(self, block):
+        # Adds a verified block that reached consensus. A block whose parent
+        # has not been added yet is kept as an orphan and connected once the
+        # parent is. Returns True if the block went on the chain.
+        with self.lock:
+            if block.index <= self.last_block.index:
+                return False
+            if block.previous_hash != self.last_block.hash:
+                self.orphans.add(block)
+                return False
+            return self.add_block(block, verified=True)
+
+    def connect_orphans(self):
+        # For after a sync, which appends without looking at waiting blocks
+        with self.lock:
+            if self.chain:
+                self._connect_waiting()
     
+    def truncate(self, length):
+        with self.lock:
+            self._truncate(length)
+
+    def _truncate(self, length):
+        # Blocks come off the tip, so the tally is rolled back newest first
+        for index in range(len(self.chain) - 1, length - 1, -1):
+            block = self.chain[index]
+            self.tally.revert_block(block)
+            for pub_key in pub_key_column(block.transactions):
+                self.spent.unmark_committed(pub_key, block.index)
+            self.index.remove(block)
+        if self.store is not None:
+            self.store.truncate(length)
+        else:
+            del self.chain[length:]
+        self.save_tally()
+    
+    def find_transaction(self, transaction_id):
+        index = self.index.block_of_transaction(transaction_id)
+        return None if index is None else self.chain[index]
+
+    def catch_up(self):
+        # For a reader of a store another process appends to: brings the
+        # tally and indexes up to the stored tip, rebuilding them if the
+        # blocks they were built from have since been replaced
+        with self.lock:
+            height = self.tally.height
+            if height > len(self.chain) or (height and self.store.hash_at(height - 1) != self.tally.tip):
+                self.tally = Tally()
+                self.spent = SpentIndex()
+                self.index = ChainIndex(track_hashes=False)
+                height = 0
+            for index in range(height, len(self.chain)):
+                block = self.chain[index]
+                self.tally.apply_block(block)
+                self.index_block(block)
+
+    def index_of_hash(self, block_hash):
+        if self.store is not None and self.chain is self.store:
+            return self.store.index_of_hash(block_hash)
+        return self.index.block_of_hash(block_hash)
+    
+    def discard_transaction(self, transaction_id):
+        # Takes a vote out of the pool along with its duplicate check entry
+        transaction = self.transactions[transaction_id]
+        del self.transactions[transaction_id]
+        self.encrypted_transactions.pop(utils.encrypt(transaction), None)
+
+    def remove_included(self, transaction_ids):
+        # Drops votes that made it into a block and records how long they waited
+        now = time.monotonic()
+        delays = []
+        for transaction_id in transaction_ids:
+            if transaction_id in self.transactions:
+                delays.append(now - self.transactions.arrived_at(transaction_id))
+                self.discard_transaction(transaction_id)
+        self.inclusion.record(delays)
+
     def create_new_block(self):
+        with self.lock:
+            return self._create_new_block()
+
+    def _create_new_block(self):
         if not self.transactions:
             return False
         
+        # Take the oldest votes up to the block size cap, the rest wait for the
+        # next block. Their signatures were checked when they were admitted.
+        transaction_ids = self.transactions.oldest(MAX_BLOCK_TXNS)
+        # A block from a peer may have committed another vote by the same voter
+        # since this one was admitted; such votes leave the pool unsealed
+        committed = [transaction_id for transaction_id in transaction_ids
+                     if self.spent.get(self.transactions[transaction_id]["pub_key"]) not in (None, PENDING)]
+        for transaction_id in committed:
+            self.discard_transaction(transaction_id)
+        if committed:
+            transaction_ids = [transaction_id for transaction_id in transaction_ids if transaction_id in self.transactions]
+        if not transaction_ids:
+            return False
+        
         index = self.last_block.index + 1
-        transactions = self.transactions
+        transactions = {transaction_id : self.transactions[transaction_id] for transaction_id in transaction_ids}
         timestamp = time.time()
         previous_hash = self.last_block.hash
-        proof_of_verification = utils.sign_block(index, transactions, timestamp, previous_hash)
         
         block = Block(index=index,
                       transactions=transactions,
-                      proof_of_verification=proof_of_verification,
+                      proof_of_verification=None,
                       timestamp=timestamp,
                       previous_hash=previous_hash
                       )
-        if proof_of_verification:
-            block.hash = block.compute_hash()
-            self.add_block(block)
-            self.transactions = {}
-            return block.__dict__
-        else:
-            return False
+        block.proof_of_verification = utils.sign_header(block.header())
+        block.hash = block.compute_hash()
+        self.add_block(block)
+        return block.to_dict()
 
 # Initialize flask application
 app =  Flask(__name__)
 
-# Initialize a blockchain object.
-PORT = int(sys.argv[1])
-blockchain = Blockchain(PORT)
+# Initialize a blockchain object, reopening the chain this node stored before a restart.
+PORT = int(sys.argv[1]) if len(sys.argv) > 1 else int(os.environ.get("VOTE_PORT", 5000))
+DEBUG = os.environ.get("VOTE_DEBUG", "1") == "1"
+DATA_DIR = os.environ.get("VOTE_DATA_DIR", "chain_data")
+SYNC_PAGE_SIZE = int(os.environ.get("VOTE_SYNC_PAGE_SIZE", 500))
+# A page also ends at the block that takes it past this many bytes of JSON,
+# full blocks run to megabytes each
+SYNC_PAGE_BYTES = int(os.environ.get("VOTE_SYNC_PAGE_BYTES", 16 * 1024 * 1024))
+CHECKPOINTS_FILE = os.environ.get("VOTE_CHECKPOINTS", "checkpoints.json")
+CHECKPOINT_INTERVAL = int(os.environ.get("VOTE_CHECKPOINT_INTERVAL", 100))
+TRACING = os.environ.get("VOTE_TRACING", "0") == "1"
+TRACE_SAMPLE = float(os.environ.get("VOTE_TRACE_SAMPLE", 0.01))
+TRACE_LOG = os.environ.get("VOTE_TRACE_LOG", os.path.join(DATA_DIR, str(PORT), "spans.jsonl"))
+PROFILE_TOKEN = os.environ.get("VOTE_PROFILE_TOKEN")
+# "single" for a standalone node; serve.py starts one "writer" and several "reader" workers
+ROLE = os.environ.get("VOTE_ROLE", "single")
+WRITER_URL = os.environ.get("VOTE_WRITER_URL", "")
+WORKER_TOKEN = os.environ.get("VOTE_WORKER_TOKEN", "")
+VERIFIED_HEADER = "X-Vote-Verified"
+tracer = tracing.Tracer("localhost:" + str(PORT), tracing.SpanLog(TRACE_LOG) if TRACING else None, TRACE_SAMPLE)
+broadcaster = Broadcaster(timeout=float(os.environ.get("VOTE_BROADCAST_TIMEOUT", 5)), tracer=tracer)
+INVENTORY_WINDOW = float(os.environ.get("VOTE_INVENTORY_WINDOW", 0.2))
+INVENTORY_MAX_ITEMS = int(os.environ.get("VOTE_INVENTORY_MAX_ITEMS", 1000))
+RECONCILE_START_SIZE = 16
+MEMPOOL_MAX_TXNS = int(os.environ.get("VOTE_MEMPOOL_MAX_TXNS", 200000))
+MEMPOOL_MAX_BYTES = int(os.environ.get("VOTE_MEMPOOL_MAX_BYTES", 256 * 1024 * 1024))
+MEMPOOL_EVICT = os.environ.get("VOTE_MEMPOOL_EVICT", "0") == "1"
+MAX_BLOCK_TXNS = int(os.environ.get("VOTE_MAX_BLOCK_TXNS", 5000))
+AUTO_SEAL = os.environ.get("VOTE_AUTO_SEAL", "1") == "1"
+BLOCK_SIZE_THRESHOLD = int(os.environ.get("VOTE_BLOCK_SIZE_THRESHOLD", MAX_BLOCK_TXNS))
+BLOCK_MAX_LATENCY = float(os.environ.get("VOTE_BLOCK_MAX_LATENCY", 2.0))
+PROPOSER_TIMEOUT = float(os.environ.get("VOTE_PROPOSER_TIMEOUT", 2.0))
+FETCH_WORKERS = int(os.environ.get("VOTE_FETCH_WORKERS", 4))
+ORPHAN_MAX_BLOCKS = int(os.environ.get("VOTE_ORPHAN_MAX_BLOCKS", 100))
+INDEX_SNAPSHOT_INTERVAL = int(os.environ.get("VOTE_INDEX_SNAPSHOT_INTERVAL", 100))
+# One writer, so snapshots reach the disk in the order they were taken
+snapshot_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+MAX_BULK_TXNS = int(os.environ.get("VOTE_MAX_BULK_TXNS", 10000))
+NDJSON_TYPES = {"application/x-ndjson", "application/ndjson"}
+WIRE_ACCEPT = {"Accept": wire.MIME + ", application/json;q=0.9"}
+# How far a compressed binary payload may inflate: anything past what the
+# largest legitimate message of its kind needs is refused
+WIRE_TRANSACTIONS_BYTES = INVENTORY_MAX_ITEMS * wire.MAX_VOTE_SIZE
+WIRE_BLOCK_BYTES = MAX_BLOCK_TXNS * wire.MAX_VOTE_SIZE
+WIRE_PAGE_BYTES = SYNC_PAGE_BYTES + WIRE_BLOCK_BYTES
+blockchain = Blockchain(PORT, store=BlockStore(os.path.join(DATA_DIR, str(PORT)), Block.from_dict, Block.to_dict,
+                                               readonly=ROLE == "reader"))
+shared_state = (SharedState(os.path.join(DATA_DIR, str(PORT), "state.db"), readonly=ROLE == "reader")
+                if ROLE != "single" else None)
         
 ##############################################################################################################
 ########################################## Other utility functions ###########################################
 ##############################################################################################################   
-def create_chain_from_dump(chain_dump):
-    blockchain = Blockchain(PORT)
-    for idx, block_data in enumerate(chain_dump):
-        block = Block(block_data["index"],
-                      block_data["transactions"],
-                      block_data["proof_of_verification"],
-                      block_data["timestamp"],
-                      block_data["previous_hash"],
-                      )
-        block.hash = block_data["hash"]
-        if idx > 0:
-            verified = utils.is_valid_block(block.__dict__)
-            added = blockchain.add_block(block, clone_mode=True)
-            if not added:
-                raise Exception("The chain dump is tampered!!")
-        else:  # the block is a genesis block, no verification needed
-            blockchain.chain.append(block)
-    return blockchain
-               
-##############################################################################################################
-####################################### FLASK END POINTS FOR THE NODE ########################################
-##############################################################################################################          
-@app.route('/new_transaction', methods=['POST'])
-def new_transaction():
-    tx_data = request.get_json()
-    required_fields = ["pub_key", "vote","sign"]    
-    for field in required_fields:
-        if not tx_data.get(field):
-            return "Invalid transaction data", 404
+def load_checkpoints():
+    # Trusted checkpoints shipped with the node's config, a JSON list of
+    # {"index", "hash", "sign"} signed with the block key
+    if not os.path.exists(CHECKPOINTS_FILE):
+        return []
+    with open(CHECKPOINTS_FILE) as f:
+        return [checkpoint for checkpoint in json.load(f) if utils.is_valid_checkpoint(checkpoint)]
+
+def share_state(chain):
+    # The writer mirrors the pool, the peers and the pending blocks into the
+    # shared state; readers swap them for read-only views of it
+    if ROLE == "writer":
+        chain.transactions.attach(shared_state)
+        chain.peers = MirroredSet(shared_state, "peers", chain.peers)
+        chain.pending_blocks = MirroredDict(shared_state, "pending_blocks", chain.pending_blocks, encode=Block.to_dict)
+        chain.pending_blocks_counts = MirroredDict(shared_state, "pending_counts", chain.pending_blocks_counts)
+    elif ROLE == "reader":
+        chain.transactions = SharedPool(shared_state, MEMPOOL_MAX_TXNS, MEMPOOL_MAX_BYTES, MEMPOOL_EVICT)
+        chain.peers = SharedSet(shared_state, "peers")
+        chain.pending_blocks = SharedDict(shared_state, "pending_blocks", decode=Block.from_dict)
+        chain.pending_blocks_counts = SharedDict(shared_state, "pending_counts")
+
+share_state(blockchain)
+
+trusted_checkpoints = load_checkpoints()
+signed_checkpoints = {}
+
+def newest_checkpoint(checkpoints):
+    checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint]
+    return max(checkpoints, key=lambda checkpoint: checkpoint["index"]) if checkpoints else None
+
+def fetch_checkpoint(node_address):
+    try:
+        checkpoint = requests.get(node_address + '/checkpoint').json()
+    except (requests.RequestException, ValueError):
+        return None
+    return checkpoint if utils.is_valid_checkpoint(checkpoint) else None
+
+def verify_block_window(block_datas, checkpoint=None):
+    # Blocks up to a trusted checkpoint only need their hashes checked, the
+    # checkpointed block's hash then vouches for every block linked below it
+    to_verify = []
+    for block_data in block_datas:
+        if block_data["index"] == 0:
+            continue
+        if checkpoint is None or block_data["index"] > checkpoint["index"]:
+            to_verify.append(block_data)
+        elif not utils.is_consistent_block(block_data):
+            return False
+        elif block_data["index"] == checkpoint["index"] and block_data["hash"] != checkpoint["hash"]:
+            return False
+    return not utils.verify_blocks(to_verify)
+
+def valid_range(start, limit):
+    # Page bounds from a request: non-negative integers, the limit optional
+    return type(start) is int and start >= 0 and (limit is None or (type(limit) is int and limit >= 0))
+
+def page_end(chain, start, limit):
+    # Where a page from start ends: after limit blocks, or after the block
+    # that takes it past SYNC_PAGE_BYTES. Without a limit it runs to the tip.
+    end = len(chain) if limit is None else min(len(chain), start + limit)
+    if limit is None or chain is not blockchain.store:
+        return end
+    size = 0
+    for index in range(start, end):
+        size += chain.record_size(index)
+        if size >= SYNC_PAGE_BYTES:
+            return index + 1
+    return end
+
+def stream_chain(chain, start, end):
+    # Yields the JSON for chain[start:end] one block at a time
+    length = len(chain)
+    yield '{"length": %d, "from": %d, "chain": [' % (length, start)
+    for index in range(start, end):
+        if index > start:
+            yield ', '
+        yield block_json(chain, index)
+    yield ']}'
+
+def block_json(chain, index):
+    # Stored records are already serialized, send them as they are
+    if chain is blockchain.store:
+        return chain.raw(index)
+    return json.dumps(chain[index].to_dict())
+
+def admit_transaction(tx_data, verified=False):
+    # Validates a vote and adds it to the pool. Returns (status, transaction_id)
+    # with status one of "accepted", "duplicate", "double_vote", "full",
+    # "invalid" or "missing_fields".
+    problem = vote_problem(tx_data)
+    if problem == "missing_fields":
+        return "missing_fields", None
+    if problem is not None:
+        return "invalid", None
         
     if "timestamp" not in tx_data:
         tx_data["timestamp"] = time.time()
-        
-    # if "sign" not in tx_data:    
-    #     tx_data["sign"] = utils.sign_transaction(tx_data["pub_key"], tx_data["vote"])
-         
-    verified = utils.verify_transaction(tx_data)
-    if not verified:
-        return "Invalid transaction", 404
-    
     
     # If the transaction is present in the local pool, return the transaction id 
     txn = {
@@ -182,36 +523,527 @@ def new_transaction():
         }
     encrypted = utils.encrypt(txn)
     if(encrypted in blockchain.encrypted_transactions):
-        return blockchain.encrypted_transactions[encrypted], 201
-    
+        return "duplicate", blockchain.encrypted_transactions[encrypted]
     
-    if "transaction_id" not in tx_data:
-        transaction_id = blockchain.add_new_transaction(tx_data)
-        tx_data["transaction_id"] = transaction_id
-    else:
-        transaction = {"pub_key" : tx_data["pub_key"], 
-                  "vote": tx_data["vote"], 
-                  "timestamp" : tx_data["timestamp"], 
-                  "sign" : tx_data["sign"]}
-        transaction_id = tx_data["transaction_id"]
-        blockchain.transactions[transaction_id] = transaction
-        blockchain.encrypted_transactions[encrypted] = transaction_id
+    # A voter who already has a vote pending or on the chain is turned away
+    # before paying for signature verification
+    if txn["pub_key"] in blockchain.spent:
+        return "double_vote", None
+    transaction_id = tx_data.get("transaction_id", "")
+    if not blockchain.transactions.has_room(transaction_id, txn):
+        return "full", None
         
+    if not verified and not utils.verify_transaction(tx_data):
+        return "invalid", None
     
-    data = {"transaction_id" :  transaction_id}
-    headers = {'Content-Type': "application/json"}
+    with blockchain.lock:
+        if not blockchain.spent.mark_pending(txn["pub_key"]):
+            return "double_vote", None
+        evicted = blockchain.transactions.make_room(transaction_id, txn)
+        if evicted is None:
+            blockchain.spent.unmark_pending(txn["pub_key"])
+            return "full", None
+        for _, transaction in evicted:
+            # Evicted voters may submit again
+            blockchain.spent.unmark_pending(transaction["pub_key"])
+            blockchain.encrypted_transactions.pop(utils.encrypt(transaction), None)
+        if "transaction_id" not in tx_data:
+            transaction_id = blockchain.add_new_transaction(tx_data)
+        else:
+            transaction_id = tx_data["transaction_id"]
+            blockchain.transactions[transaction_id] = txn
+            blockchain.encrypted_transactions[encrypted] = transaction_id
+    if tracing.current() is not None:
+        traced_votes[transaction_id] = tracing.current()
+    scheduler.notify()
+    return "accepted", transaction_id
 
-    responses = []    
-    for peer in blockchain.peers:
-        resp = requests.post(peer+'/receive_adv_txn', data=json.dumps(data), headers=headers).json()
-        responses.append(resp)
-        
-    for response in responses:
-        if(response["requested"]):
-            requests.post(response["peer"] + '/new_transaction', data=json.dumps(tx_data), headers=headers)
-             
+# Span of the request that admitted each traced vote, until its batch goes out
+traced_votes = {}
+
+def announce_transactions(transaction_ids):
+    # A batch carries on the trace of the first traced vote in it
+    parents = [traced_votes.pop(transaction_id) for transaction_id in transaction_ids if transaction_id in traced_votes]
+    with tracer.span("announce_transactions", root=True, parent=parents[0] if parents else None,
+                     votes=len(transaction_ids), traced_votes=len(parents)):
+        send_inventory(transaction_ids)
+
+def send_inventory(transaction_ids):
+    # One inventory message per peer for the whole batch; each peer answers
+    # with the ids it is missing and gets those bodies in one payload
+    data = {"peer" : "http://localhost:" + str(blockchain.PORT),
+            "transaction_ids" : transaction_ids}
+    responses = broadcaster.post_all(list(blockchain.peers), '/receive_inv', data)
+    payloads = {}
+    for response in responses.values():
+        if response is None:
+            continue
+        try:
+            jsn = response.json()
+        except ValueError:
+            continue
+        bodies = {transaction_id : blockchain.transactions[transaction_id]
+                  for transaction_id in jsn.get("requested", []) if transaction_id in blockchain.transactions}
+        if not bodies:
+            continue
+        payloads[jsn["peer"]] = ('/receive_transactions', {"transactions" : bodies})
+        if jsn.get("wire"):
+            try:
+                payloads[jsn["peer"]] = ('/receive_transactions', wire.encode_transactions(bodies),
+                                         {"Content-Type": wire.MIME})
+            except ValueError:
+                pass
+    broadcaster.post_each(payloads)
+
+inventory = InventoryBatcher(announce_transactions, window=INVENTORY_WINDOW, max_items=INVENTORY_MAX_ITEMS)
+
+def seal_and_broadcast():
+    # Seals the pool into a block and advertises it to every peer
+    with tracer.span("seal_block", root=True) as span:
+        block = blockchain.create_new_block()
+        if block:
+            if span is not None:
+                span["attributes"].update(index=block["index"], votes=len(block["transactions"]))
+            data = {"peer" : "http://localhost:" + str(blockchain.PORT),
+                    "block_id" : block["index"]}
+            broadcaster.submit(broadcaster.post_all, list(blockchain.peers), '/receive_adv_block', data)
+        return block
+
+def may_seal(oldest_age):
+    # Only the proposer for the next height seals it. Every PROPOSER_TIMEOUT
+    # the pool stays overdue, the turn moves on to the next member.
+    if not AUTO_SEAL or not blockchain.chain:
+        return False
+    members = set(blockchain.peers) | {"http://localhost:" + str(PORT)}
+    overdue_rounds = int(max(0.0, oldest_age - BLOCK_MAX_LATENCY) // PROPOSER_TIMEOUT)
+    height = blockchain.last_block.index + 1
+    return proposer_for(height, members, overdue_rounds) == "http://localhost:" + str(PORT)
+
+scheduler = BlockScheduler(seal_and_broadcast, lambda: blockchain.transactions, may_seal,
+                           size_threshold=BLOCK_SIZE_THRESHOLD, max_latency=BLOCK_MAX_LATENCY)
+
+def fetch_block(peer, block_id):
+    # Runs on a fetcher thread: downloads an advertised block and verifies it
+    data = {"block_id" : block_id,
+            "peer" : "http://localhost:" + str(PORT)}
+    response = broadcaster.post(peer, '/request_block', data, headers=WIRE_ACCEPT)
+    if response is None:
+        return None
+    requested_block = wire.decode_response(response, WIRE_BLOCK_BYTES)
+    if "error" in requested_block or requested_block.get("index") != block_id:
+        return None
+    block = Block.from_dict(requested_block)
+    if not utils.is_valid_block(block.to_dict()):
+        return None
+    return block
+
+def receive_fetched_block(block, peer):
+    # Keeps a fetched block as pending, passes the advertisement on and adds
+    # the block if enough peers have advertised it meanwhile
+    with blockchain.lock:
+        if block.index <= blockchain.last_block.index:
+            return
+        blockchain.pending_blocks[block.index] = block
+        blockchain.received_block_advertises.add(block.index)
+    data = {"peer" : "http://localhost:" + str(PORT),
+            "block_id" : block.index}
+    broadcaster.submit(broadcaster.post_all, list(blockchain.peers), '/receive_adv_block', data)
+    connect_pending(block.index, peer)
+
+def connect_pending(block_id, peer):
+    # Adds a pending block once enough peers advertised it, or once an orphan
+    # that did is waiting on it. If its own parent is still missing, the
+    # parent is connected or fetched from the peer. Returns True if blocks
+    # went on the chain.
+    with blockchain.lock:
+        block = blockchain.pending_blocks.get(block_id)
+        if block is None:
+            return False
+        if (blockchain.pending_blocks_counts.get(block_id, 0) < (len(blockchain.peers) + 1)//2
+                and not blockchain.orphans.waiting_on(block.hash)):
+            return False
+        del blockchain.pending_blocks[block_id]
+        if blockchain.connect_block(block):
+            return True
+        parent_id = block_id - 1
+        if parent_id <= blockchain.last_block.index:
+            return False
+        if parent_id in blockchain.pending_blocks:
+            return connect_pending(parent_id, peer)
+    block_fetcher.request(parent_id, peer)
+    return False
+
+block_fetcher = BlockFetcher(fetch_block, receive_fetched_block, max_workers=FETCH_WORKERS)
+
+def reconcile_mempool(node_address):
+    # Swaps IBLT sketches of the pending ids with a peer, starting small and
+    # doubling until the difference decodes, then transfers only the votes
+    # that differ. Falls back to the full pool if even our largest sketch
+    # cannot hold the difference.
+    size = RECONCILE_START_SIZE
+    jsn = None
+    while size <= blockchain.transactions.sketch.size:
+        data = {"peer" : "http://localhost:" + str(blockchain.PORT),
+                "sketch" : blockchain.transactions.sketch.fold(size).to_json()}
+        response = broadcaster.post(node_address, '/reconcile', data)
+        if response is None:
+            return None
+        if not response.ok:
+            jsn = None
+            break
+        jsn = response.json()
+        if jsn.get("decoded"):
+            break
+        size *= 2
+    if jsn is None or not jsn.get("decoded"):
+        jsn = {"transactions": requests.get(node_address + '/get_transactions').json(), "missing": []}
+    
+    accepted = []
+    for transaction_id, transaction in jsn["transactions"].items():
+        status, _ = admit_transaction(dict(transaction, transaction_id=transaction_id))
+        if status == "accepted":
+            accepted.append(transaction_id)
+    inventory.add_many(accepted)
+    
+    # Send the peer the votes only we have
+    bodies = {}
+    for key in jsn["missing"]:
+        transaction_id = blockchain.transactions.id_for_key(int(key, 16))
+        if transaction_id is not None:
+            bodies[transaction_id] = blockchain.transactions[transaction_id]
+    if bodies:
+        broadcaster.post(node_address, '/receive_transactions', {"transactions" : bodies})
+    return {"received": len(accepted), "sent": len(bodies), "sketch_size": size}
+
+def fetch_chain_page(node_address, start):
+    response = requests.get(node_address + '/get_chain',
+                            params={"from": start, "limit": SYNC_PAGE_SIZE}, headers=WIRE_ACCEPT)
+    return wire.decode_response(response, WIRE_PAGE_BYTES)
+
+def wants_wire():
+    return wire.MIME in request.headers.get('Accept', '')
+
+def block_response(block_data):
+    # Binary for peers that asked for it, JSON for everyone else and for
+    # blocks the binary format cannot carry
+    if wants_wire():
+        try:
+            return Response(wire.encode_block(block_data), mimetype=wire.MIME)
+        except ValueError:
+            pass
+    return json.dumps(block_data)
+
+def extend_chain(target, node_address, checkpoint=None):
+    # Appends the peer's blocks past target's tip. The next page is fetched
+    # while the current one is validated. Returns the number of blocks added,
+    # or None if the peer's chain does not extend target's.
+    # Nothing else may append meanwhile: a rollback would take its blocks
+    # off with the peer's, after their votes already left the pool
+    with target.lock:
+        start = len(target.chain)
+        try:
+            return fetch_blocks(target, node_address, start, checkpoint)
+        except Exception:
+            # Blocks below a checkpoint are only trusted once the checkpoint itself matched
+            target.truncate(start)
+            raise
+
+def fetch_blocks(target, node_address, start, checkpoint):
+    added = 0
+    with ThreadPoolExecutor(max_workers=1) as fetcher:
+        next_page = fetcher.submit(fetch_chain_page, node_address, start)
+        while next_page is not None:
+            page = next_page.result()
+            blocks = page["chain"]
+            if not blocks:
+                break
+            start += len(blocks)
+            next_page = fetcher.submit(fetch_chain_page, node_address, start) if start < page["length"] else None
+            if checkpoint is not None and checkpoint["index"] >= page["length"]:
+                # A peer chain shorter than the checkpoint is synced without it,
+                # unless blocks were already taken on the checkpoint's word
+                if added and len(target.chain) <= checkpoint["index"]:
+                    raise Exception("The chain dump is tampered!!")
+                checkpoint = None
+            
+            if target.chain and not added and blocks[0]["previous_hash"] != target.last_block.hash:
+                return None
+            if not verify_block_window(blocks, checkpoint):
+                raise Exception("The chain dump is tampered!!")
+            length = len(target.chain)
+            for block_data in blocks:
+                block = Block.from_dict(block_data)
+                if not target.chain:  # the block is a genesis block, no verification needed
+                    target.append_block(block)
+                elif not target.add_block(block, clone_mode=True, verified=True):
+                    raise Exception("The chain dump is tampered!!")
+                added += 1
+            target.save_snapshots(length)
+    # Blocks below the checkpoint only had their hashes checked, they stand
+    # only if the checkpointed block itself arrived and matched
+    if checkpoint is not None and added and len(target.chain) <= checkpoint["index"]:
+        raise Exception("The chain dump is tampered!!")
+    return added
+
+def adopt_chain(blockchain_new):
+    # Replaces the node's chain with a validated longer one, keeping peers and ids
+    global blockchain
+    blockchain_new.peers = blockchain.peers
+    blockchain_new.sequence_number = blockchain.sequence_number
+    blockchain_new.inclusion = blockchain.inclusion
+    # Threads already waiting on the old chain's lock wait for the new one too
+    blockchain_new.lock = blockchain.lock
+    with blockchain.lock:
+        share_state(blockchain_new)
+        if blockchain.store is not None:
+            # Only overwrite the stored chain once the new one has been validated
+            blockchain.store.truncate(0)
+            blockchain.store.extend(blockchain_new.chain)
+            blockchain_new.chain = blockchain_new.store = blockchain.store
+            blockchain_new.save_tally()
+            blockchain_new.save_indexes()
+        blockchain = blockchain_new
+
+def sync_chain(node_address):
+    # A block sealed mid-sync would land amid the peer's blocks, or be lost
+    # with its votes when a forked chain is adopted
+    with scheduler.paused():
+        return _sync_chain(node_address)
+
+def _sync_chain(node_address):
+    start = time.time()
+    checkpoint = newest_checkpoint(trusted_checkpoints + [fetch_checkpoint(node_address)])
+    added = extend_chain(blockchain, node_address, checkpoint)
+    if added is None:
+        # The chains forked, rebuild the peer's chain and keep it if it is longer
+        blockchain_new = Blockchain(PORT)
+        extend_chain(blockchain_new, node_address, checkpoint)
+        if len(blockchain_new.chain) > len(blockchain.chain):
+            adopt_chain(blockchain_new)
+        added = len(blockchain_new.chain)
+    blockchain.connect_orphans()
+    elapsed = max(time.time() - start, 1e-6)
+    app.logger.info("Synced %d blocks from %s in %.2fs (%.0f blocks/s)", added, node_address, elapsed, added / elapsed)
+    return added
+               
+##############################################################################################################
+####################################### FLASK END POINTS FOR THE NODE ########################################
+##############################################################################################################          
+# Routes peers call on each other, counted as received gossip
+GOSSIP_ENDPOINTS = {"receive_advertise_txn", "receive_inventory", "receive_transactions", "reconcile",
+                    "send_requested_block", "receive_advertise_block", "register_new_peers"}
+
+metrics.registry.gauge("vote_mempool_transactions", "Votes waiting in the pool", lambda: len(blockchain.transactions))
+metrics.registry.gauge("vote_mempool_bytes", "Approximate memory held by the pool", lambda: blockchain.transactions.bytes)
+metrics.registry.gauge("vote_chain_height", "Blocks on the chain", lambda: len(blockchain.chain))
+metrics.registry.gauge("vote_pending_blocks", "Advertised blocks waiting for enough peers", lambda: len(blockchain.pending_blocks))
+metrics.registry.gauge("vote_orphan_blocks", "Blocks waiting for their parent", lambda: len(blockchain.orphans))
+metrics.registry.gauge("vote_peers", "Registered peers", lambda: len(blockchain.peers))
+
+# Routes where a vote or a block enters the network, where new traces start
+TRACE_ROOT_ENDPOINTS = {"new_transaction", "new_transactions", "propose_block"}
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.trace = tracer.start_request(request.endpoint or "unmatched", request.headers,
+                                   root=request.endpoint in TRACE_ROOT_ENDPOINTS)
+
+# Routes a reader worker answers itself from the store and the shared state;
+# every other route changes the node and is passed on to the writer
+READ_ENDPOINTS = {"get_chain", "get_transactions", "mempool_stats", "results", "audit_chain", "key_cache_stats",
+                  "send_requested_block", "transaction_proof", "block_by_hash", "get_transaction", "blocks_in_range",
+                  "get_checkpoint", "get_peers", "get_metrics", "debug_profile", "receive_advertise_txn",
+                  "receive_inventory"}
+HOP_HEADERS = {"host", "content-length", "content-encoding", "transfer-encoding", "connection", "keep-alive"}
+writer_session = requests.Session()
+
+@app.before_request
+def route_worker_request():
+    if ROLE != "reader":
+        return None
+    if request.endpoint is None or request.endpoint in READ_ENDPOINTS:
+        blockchain.catch_up()
+        return None
+    # Signature checks are the expensive part of taking in votes, so readers
+    # do them and spread them over every worker; the writer only admits
+    if request.endpoint == "new_transaction":
+        tx_data = request.get_json(silent=True)
+        if vote_problem(tx_data) is None:
+            if not utils.verify_transaction(tx_data):
+                return "Invalid transaction", 404
+            return forward_to_writer(verified=True)
+    elif request.endpoint == "receive_transactions":
+        transactions = received_transactions()
+        if transactions is None:
+            return "Invalid payload", 400
+        complete = {transaction_id : transaction for transaction_id, transaction in transactions.items()
+                    if vote_problem(transaction) is None}
+        transaction_ids = list(complete)
+        failed = set(utils.verify_transactions(complete[transaction_id] for transaction_id in transaction_ids))
+        verified = {transaction_id : complete[transaction_id] for position, transaction_id in enumerate(transaction_ids)
+                    if position not in failed}
+        return forward_to_writer(json.dumps({"transactions" : verified}), verified=True)
+    elif request.endpoint == "new_transactions":
+        votes = received_votes()
+        if votes is None:
+            return "Invalid payload", 400
+        if len(votes) > MAX_BULK_TXNS:
+            return "At most {} transactions per request".format(MAX_BULK_TXNS), 413
+        return forward_to_writer(json.dumps({"transactions" : votes, "checked" : checked_votes(votes)}),
+                                 verified=True)
+    return forward_to_writer()
+
+def forward_to_writer(data=None, verified=False):
+    # Replays the request against the writer and relays its response
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_HEADERS}
+    headers.update(tracing.headers())
+    if data is not None:
+        headers["Content-Type"] = "application/json"
+    if verified:
+        headers[VERIFIED_HEADER] = WORKER_TOKEN
+    response = writer_session.request(request.method, WRITER_URL + request.full_path, headers=headers,
+                                      data=request.get_data() if data is None else data)
+    return Response(response.content, response.status_code,
+                    [(name, value) for name, value in response.headers.items() if name.lower() not in HOP_HEADERS])
+
+def verified_by_reader():
+    # Votes a reader worker already checked come with the node's worker token
+    return (ROLE == "writer" and bool(WORKER_TOKEN)
+            and hmac.compare_digest(request.headers.get(VERIFIED_HEADER, ""), WORKER_TOKEN))
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or "unmatched"
+    metrics.http_seconds.observe(time.perf_counter() - g.request_start, endpoint, request.method, response.status_code)
+    if endpoint in GOSSIP_ENDPOINTS:
+        metrics.gossip_received.inc(endpoint)
+    g.status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_span(exc):
+    tracer.finish_request(g.pop("trace", None), status=g.get("status", 500))
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    # ?mode=cpu|memory&seconds=<n>, with "Authorization: Bearer <VOTE_PROFILE_TOKEN>".
+    # Disabled unless the token is configured. ?idle=1 keeps waiting threads
+    # in the CPU samples, ?format=collapsed returns the CPU stacks as text
+    # for flame graph tools.
+    if not PROFILE_TOKEN:
+        return "Profiling is disabled", 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + PROFILE_TOKEN):
+        return "Unauthorized", 401
+    mode = request.args.get('mode', 'cpu')
+    if mode not in ("cpu", "memory"):
+        return "Invalid mode", 400
+    seconds = request.args.get('seconds', 5, type=float)
+    if not math.isfinite(seconds):
+        return "Invalid seconds", 400
+    try:
+        result = profiling.profile(mode, seconds, include_idle=request.args.get('idle') == "1")
+    except profiling.ProfileBusy:
+        return "A profile is already running", 409
+    if mode == "cpu" and request.args.get('format') == "collapsed":
+        return Response(result["collapsed"], mimetype='text/plain')
+    return json.dumps(result)
+
+@app.route('/new_transaction', methods=['POST'])
+def new_transaction():
+    tx_data = request.get_json()
+    status, transaction_id = admit_transaction(tx_data, verified=verified_by_reader())
+    if status == "missing_fields":
+        return "Invalid transaction data", 404
+    if status == "invalid":
+        return "Invalid transaction", 404
+    if status == "double_vote":
+        return "Voter has already voted", 409
+    if status == "full":
+        return "Transaction pool is full, retry later", 429, {"Retry-After": "1"}
+    if status == "accepted":
+        # The vote is stored locally, peers hear about it in the next inventory batch
+        inventory.add(transaction_id)
     return str(transaction_id), 201
 
+def received_votes():
+    # Votes from a JSON array, or from an NDJSON stream with one vote per
+    # line. Entries that are not JSON objects come back as None, the whole
+    # payload as None if it is not an array.
+    if request.mimetype in NDJSON_TYPES:
+        votes = []
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                vote = json.loads(line)
+            except ValueError:
+                vote = None
+            votes.append(vote if isinstance(vote, dict) else None)
+        return votes
+    votes = request.get_json(silent=True)
+    if not isinstance(votes, list):
+        return None
+    return [vote if isinstance(vote, dict) else None for vote in votes]
+
+def vote_problem(vote):
+    # Why a submitted vote cannot be checked at all, None if it can
+    if not isinstance(vote, dict):
+        return "malformed"
+    values = [vote.get(field) for field in ("pub_key", "vote", "sign")]
+    if not all(values):
+        return "missing_fields"
+    if not all(isinstance(value, str) for value in values):
+        return "malformed"
+    return None
+
+def checked_votes(votes):
+    # Whether each vote's signature holds, checked in one parallel batch.
+    # Voters who already voted are left unchecked (None): admission turns
+    # them away, or checks the signature itself if the voter was freed since.
+    positions = [position for position, vote in enumerate(votes)
+                 if vote_problem(vote) is None and vote["pub_key"] not in blockchain.spent]
+    failed = set(utils.verify_transactions([votes[position] for position in positions]))
+    checked = [None] * len(votes)
+    for index, position in enumerate(positions):
+        checked[position] = index not in failed
+    return checked
+
+@app.route('/new_transactions', methods=['POST'])
+def new_transactions():
+    # Bulk submission: a JSON array of votes, or NDJSON with one vote per
+    # line. Returns a status and transaction id per vote, in order; the
+    # accepted votes go to peers in a single announcement.
+    if verified_by_reader():
+        jsn = request.get_json()
+        votes, checked = jsn["transactions"], jsn["checked"]
+    else:
+        votes = received_votes()
+        if votes is None:
+            return "Invalid payload", 400
+        if len(votes) > MAX_BULK_TXNS:
+            return "At most {} transactions per request".format(MAX_BULK_TXNS), 413
+        checked = checked_votes(votes)
+    
+    results = []
+    accepted = []
+    for position, vote in enumerate(votes):
+        status, transaction_id = vote_problem(vote), None
+        if status is None and checked[position] is False:
+            status = "invalid"
+        if status is None:
+            status, transaction_id = admit_transaction(vote, verified=checked[position] is True)
+        if status == "accepted":
+            accepted.append(transaction_id)
+        results.append({"status" : status, "transaction_id" : transaction_id})
+    if accepted:
+        broadcaster.submit(announce_transactions, accepted)
+    return json.dumps({"accepted" : len(accepted), "results" : results})
+
 @app.route('/receive_adv_txn', methods=['POST'])
 def receive_advertise_txn():
     jsn = request.get_json()
@@ -222,26 +1054,124 @@ def receive_advertise_txn():
 
 
     
+@app.route('/receive_inv', methods=['POST'])
+def receive_inventory():
+    jsn = request.get_json()
+    requested = [transaction_id for transaction_id in jsn.get("transaction_ids", [])
+                 if transaction_id not in blockchain.transactions]
+    return json.dumps({"requested": requested,
+                       "peer" : "http://localhost:" + str(blockchain.PORT),
+                       "wire" : True})
+
+def received_transactions():
+    # Transaction bodies from a binary or JSON payload, None if it does not decode
+    if request.mimetype == wire.MIME:
+        try:
+            return wire.decode(request.get_data(), WIRE_TRANSACTIONS_BYTES)
+        except ValueError:
+            return None
+    jsn = request.get_json(silent=True)
+    transactions = jsn.get("transactions", {}) if isinstance(jsn, dict) else None
+    return transactions if isinstance(transactions, dict) else None
+
+@app.route('/receive_transactions', methods=['POST'])
+def receive_transactions():
+    # Bodies for the ids this node asked for after an inventory message
+    transactions = received_transactions()
+    if transactions is None:
+        return "Invalid payload", 400
+    verified = verified_by_reader()
+    accepted = []
+    for transaction_id, transaction in transactions.items():
+        if not isinstance(transaction, dict):
+            continue
+        tx_data = dict(transaction, transaction_id=transaction_id)
+        status, _ = admit_transaction(tx_data, verified=verified)
+        if status == "accepted":
+            accepted.append(transaction_id)
+    inventory.add_many(accepted)
+    return json.dumps({"accepted": len(accepted)}), 201
+
+@app.route('/reconcile', methods=['POST'])
+def reconcile():
+    # Decodes the difference between the peer's sketch and ours. Replies with
+    # the votes the peer lacks and the keys of the votes we lack.
+    jsn = request.get_json()
+    try:
+        theirs = iblt.IBLT.from_json(jsn["sketch"])
+        ours = blockchain.transactions.sketch.fold(theirs.size)
+    except (KeyError, ValueError):
+        return "Invalid sketch", 400
+    difference = ours.subtract(theirs).decode()
+    if difference is None:
+        return json.dumps({"decoded": False})
+    only_ours, only_theirs = difference
+    transactions = {}
+    for key in only_ours:
+        transaction_id = blockchain.transactions.id_for_key(key)
+        if transaction_id is not None:
+            transactions[transaction_id] = blockchain.transactions[transaction_id]
+    return json.dumps({"decoded": True,
+                       "transactions": transactions,
+                       "missing": ["%x" % key for key in only_theirs]})
+
+@app.route('/sync_mempool', methods=['POST'])
+def sync_mempool():
+    node_address = request.get_json()["node_address"]
+    if not node_address:
+        return "Invalid data", 400
+    result = reconcile_mempool(node_address)
+    if result is None:
+        return "Peer unreachable", 502
+    return json.dumps(result)
+
+@app.route('/results', methods=['GET'])
+def results():
+    # Served from the incremental tally, no chain reads
+    return json.dumps(blockchain.tally.results())
+
+@app.route('/audit', methods=['GET'])
+def audit_chain():
+    # Explicit columnar recount of the chain, checked against the incremental tally
+    columns = audit.export_columns(blockchain.chain)
+    recount = audit.report(columns)
+    incremental = blockchain.tally.results()
+    matches = (recount["counts"] == incremental["counts"]
+               and len(columns["block_timestamp"]) == incremental["height"])
+    return json.dumps({"matches": matches,
+                       "incremental": incremental,
+                       "recount": recount})
+
+@app.route('/mempool_stats', methods=['GET'])
+def mempool_stats():
+    return json.dumps(blockchain.transactions.stats())
+
+@app.route('/key_cache_stats', methods=['GET'])
+def key_cache_stats():
+    return json.dumps(utils.key_cache.stats())
+
 @app.route('/get_transactions', methods=['GET'])
 def get_transactions():
-    return json.dumps(blockchain.transactions)
+    return json.dumps(blockchain.transactions.to_dict())
 
 @app.route('/propose_block', methods=['GET'])
 def propose_block():
-    block = blockchain.create_new_block()
+    block = seal_and_broadcast()
     
     if not block:
         return "No transactions to add, Block not added", 201
-    
-    headers = {'Content-Type': "application/json"}
-    data = {"peer" : "http://localhost:" + str(blockchain.PORT),
-            "block_id" : block["index"]}
-    
-    for peer in blockchain.peers:
-        requests.post(peer + '/receive_adv_block', data=json.dumps(data), headers=headers)
         
     return json.dumps(block)
 
+@app.route('/block_stats', methods=['GET'])
+def block_stats():
+    # Scheduler and fetcher activity, orphans waiting for a parent, and
+    # seconds from a vote arriving to it being sealed
+    return json.dumps({"scheduler": scheduler.stats(),
+                       "time_to_inclusion": blockchain.inclusion.stats(),
+                       "fetcher": block_fetcher.stats(),
+                       "orphans": len(blockchain.orphans)})
+
    
 @app.route('/request_block', methods=['POST'])
 def send_requested_block():
@@ -252,13 +1182,68 @@ def send_requested_block():
     
     block_id = jsn["block_id"]
     if block_id <= blockchain.last_block.index:
-        return json.dumps(blockchain.chain[jsn["block_id"]].__dict__)
+        if not wants_wire():
+            return block_json(blockchain.chain, block_id)
+        return block_response(blockchain.chain[block_id].to_dict())
     else:
         if block_id in blockchain.pending_blocks:
-            return json.dumps(blockchain.pending_blocks[block_id].__dict__)
+            return block_response(blockchain.pending_blocks[block_id].to_dict())
         else:
             return json.dumps({"error" : "No block with given ID found", "code": 404})            
 
+@app.route('/proof/<transaction_id>', methods=['GET'])
+def transaction_proof(transaction_id):
+    # Everything a light client needs to check one vote: the signed block
+    # header and the Merkle path from the transaction up to its root
+    block = blockchain.find_transaction(transaction_id)
+    if block is None:
+        if transaction_id in blockchain.transactions:
+            return json.dumps({"error" : "Transaction is not in a block yet", "code": 404})
+        return json.dumps({"error" : "No transaction with given ID found", "code": 404})
+    
+    header = block.header()
+    header["proof_of_verification"] = block.proof_of_verification
+    header["hash"] = block.hash
+    return json.dumps({"transaction_id" : transaction_id,
+                       "transaction" : block.transactions[transaction_id],
+                       "block" : header,
+                       "path" : merkle.merkle_path(block.transactions, transaction_id)})
+
+@app.route('/block_by_hash/<block_hash>', methods=['GET'])
+def block_by_hash(block_hash):
+    index = blockchain.index_of_hash(block_hash)
+    if index is None:
+        return json.dumps({"error" : "No block with given hash found", "code": 404})
+    if wants_wire():
+        return block_response(blockchain.chain[index].to_dict())
+    return block_json(blockchain.chain, index)
+
+@app.route('/transaction/<transaction_id>', methods=['GET'])
+def get_transaction(transaction_id):
+    block = blockchain.find_transaction(transaction_id)
+    if block is None:
+        if transaction_id in blockchain.transactions:
+            return json.dumps({"transaction_id" : transaction_id,
+                               "transaction" : blockchain.transactions[transaction_id],
+                               "block_index" : None,
+                               "block_hash" : None})
+        return json.dumps({"error" : "No transaction with given ID found", "code": 404})
+    return json.dumps({"transaction_id" : transaction_id,
+                       "transaction" : block.transactions[transaction_id],
+                       "block_index" : block.index,
+                       "block_hash" : block.hash})
+
+@app.route('/blocks', methods=['GET'])
+def blocks_in_range():
+    # ?since=<timestamp>&until=<timestamp>, both inclusive, oldest block first,
+    # at most limit (default one sync page) blocks
+    since = request.args.get('since', type=float)
+    until = request.args.get('until', type=float)
+    limit = request.args.get('limit', SYNC_PAGE_SIZE, type=int)
+    indexes = blockchain.index.blocks_between(since, until, limit)
+    return Response('{"count": %d, "blocks": [%s]}' % (len(indexes), ', '.join(block_json(blockchain.chain, index) for index in indexes)),
+                    mimetype='application/json')
+
 @app.route('/receive_adv_block', methods=['POST'])
 def receive_advertise_block():
     jsn = request.get_json()
@@ -266,50 +1251,20 @@ def receive_advertise_block():
         return "Invalid request", 404
     
     block_id = jsn.get('block_id')
-    if block_id <= blockchain.last_block.index:
-        return json.dumps({"error " : "error"})
-
-    if block_id not in blockchain.received_block_advertises:
-        data = {"block_id" : block_id, 
-                "peer" : "http://localhost:" + str(PORT)}
-        headers = {'Content-Type': "application/json"}
-        
-        requested_block = requests.post(jsn["peer"] + '/request_block', data=json.dumps(data), headers=headers).json()
-        block = Block(
-                index = requested_block['index'],
-                transactions = requested_block['transactions'],
-                proof_of_verification =  requested_block['proof_of_verification'],
-                timestamp = requested_block['timestamp'],
-                previous_hash = requested_block['previous_hash']
-            )
-        block.hash = requested_block['hash']
-        verified = utils.is_valid_block(block.__dict__)
-        if not verified:
+    with blockchain.lock:
+        if not blockchain.chain or block_id <= blockchain.last_block.index:
             return json.dumps({"error " : "error"})
-        
-        for transaction in block.transactions:
-            if transaction in blockchain.transactions:
-                del blockchain.transactions[transaction]
-        
-        assert (requested_block["index"] == block_id)
-        blockchain.pending_blocks[block_id] = block
-        blockchain.pending_blocks_counts[block_id] = 1    
-        blockchain.received_block_advertises.add(block_id)
-        for peer in blockchain.peers:
-            requests.post(peer + '/receive_adv_block', data = json.dumps(data), headers=headers)
-        
-    else:
-        blockchain.pending_blocks_counts[block_id] += 1
-        
-    if(blockchain.pending_blocks_counts[block_id] >= (len(blockchain.peers) + 1)//2):
-        if block_id in blockchain.pending_blocks:
-            blockchain.add_block(blockchain.pending_blocks[block_id])
-            del blockchain.pending_blocks[block_id]
-            return str(block_id)
-        else:
-            return json.dumps({"error " : "error"})
-    else:
-        return json.dumps({"error " : "error"})
+        # Every advertisement counts towards consensus, the block itself is
+        # fetched once and in the background
+        blockchain.pending_blocks_counts[block_id] = blockchain.pending_blocks_counts.get(block_id, 0) + 1
+        fetched = block_id in blockchain.received_block_advertises
+    
+    if not fetched:
+        block_fetcher.request(block_id, jsn["peer"])
+        return json.dumps({"block_id" : block_id, "status" : "fetching"})
+    if connect_pending(block_id, jsn["peer"]):
+        return str(block_id)
+    return json.dumps({"error " : "error"})
         
 @app.route('/create_genesis_block', methods=['GET'])
 def create_genesis_block():
@@ -321,11 +1276,34 @@ def create_genesis_block():
             
 @app.route('/get_chain', methods=['GET'])
 def get_chain():
-    chain_data = []
-    for block in blockchain.chain:
-        chain_data.append(block.__dict__)
-    return json.dumps({"length": len(chain_data),
-                       "chain": chain_data})
+    # ?from=<index>&limit=<n> returns one page, without them the whole chain
+    start = request.args.get('from', 0, type=int)
+    limit = request.args.get('limit', type=int)
+    if not valid_range(start, limit):
+        return "Invalid range", 400
+    chain = blockchain.chain
+    end = page_end(chain, start, limit)
+    if limit is not None and wants_wire():
+        try:
+            page = wire.encode_chain_page(len(chain), start, [chain[index].to_dict() for index in range(start, end)])
+            return Response(page, mimetype=wire.MIME)
+        except ValueError:
+            pass
+    return Response(stream_chain(chain, start, end), mimetype='application/json')
+
+@app.route('/checkpoint', methods=['GET'])
+def get_checkpoint():
+    # The newest checkpoint we can vouch for: a configured one, or the last
+    # block of ours at a multiple of CHECKPOINT_INTERVAL
+    index = (len(blockchain.chain) - 1) // CHECKPOINT_INTERVAL * CHECKPOINT_INTERVAL
+    if index > 0:
+        block_hash = blockchain.chain[index].hash
+        if signed_checkpoints.get(index, {}).get("hash") != block_hash:
+            signed_checkpoints[index] = utils.sign_checkpoint(index, block_hash)
+    checkpoint = newest_checkpoint(trusted_checkpoints + [signed_checkpoints.get(index)])
+    if checkpoint is None:
+        return json.dumps({"error" : "No checkpoint available", "code": 404})
+    return json.dumps(checkpoint)
 
 @app.route('/register_node', methods=['POST'])
 def register_new_peers():
@@ -337,8 +1315,14 @@ def register_new_peers():
     # Add the node to the peer list
     blockchain.peers.add(node_address)
 
-    # Return the blockchain to the newly registered node so that it can sync
-    return get_chain()
+    # Return the blockchain to the newly registered node so that it can sync.
+    # Nodes that sync page by page send from/limit to get only the length.
+    jsn = request.get_json()
+    start, limit = jsn.get("from", 0), jsn.get("limit")
+    if not valid_range(start, limit):
+        return "Invalid range", 400
+    return Response(stream_chain(blockchain.chain, start, page_end(blockchain.chain, start, limit)),
+                    mimetype='application/json')
 
 
 @app.route('/register_with', methods=['POST'])
@@ -347,7 +1331,9 @@ def register_with_existing_node():
     if not node_address:
         return "Invalid data", 400
 
-    data = {"node_address": "http://localhost:" + str(PORT)}
+    data = {"node_address": "http://localhost:" + str(PORT),
+            "from": len(blockchain.chain),
+            "limit": 0}
     headers = {'Content-Type': "application/json"}
 
     # Make a request to register with remote node and obtain information
@@ -355,13 +1341,10 @@ def register_with_existing_node():
                              data=json.dumps(data), headers=headers)
 
     if response.status_code == 200:
-        global blockchain
-        chain_dump = response.json()['chain']
         blockchain.peers.add(node_address)
-        blockchain_new = create_chain_from_dump(chain_dump)
-        if(len(blockchain_new.chain) > len(blockchain.chain)):
-            blockchain_new.peers = blockchain.peers
-            blockchain = blockchain_new
+        # Fetch only the blocks past our tip, page by page, then the votes we missed
+        sync_chain(node_address)
+        reconcile_mempool(node_address)
         return "Registration successful", 200
     else:
         # if something goes wrong, pass it on to the API response
@@ -371,15 +1354,23 @@ def register_with_existing_node():
 def get_peers():
     return jsonify(results=list(blockchain.peers))
 
-# Running the app
-app.run(host='localhost', port=PORT, debug=True)
+@app.route('/peer_stats', methods=['GET'])
+def peer_stats():
+    # Posts, failures and latency (seconds) per peer, as seen by the broadcaster
+    return json.dumps(broadcaster.stats())
 
 @app.route('/remove_peers', methods=['POST'])
 def remove_peer():
     node_address = request.get_json()["node_address"]
     blockchain.peers.remove(node_address)
+    broadcaster.forget(node_address)
     return "Peer {} removed successfully".format(node_address), 201
 
+# Running the app
+if __name__ == '__main__':
+    utils.start_verify_pool()
+    app.run(host='localhost', port=PORT, debug=DEBUG)
+
     
     
     
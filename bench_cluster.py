@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import requests
+from ecdsa import SigningKey, NIST384p
+
+# Starts a local cluster of bc_py3.py nodes, meshes them, replays a corpus of
+# signed votes and records throughput, block propagation, late-joiner sync
+# and per-node memory as JSON so runs can be compared:
+#   python bench_cluster.py --nodes 3 --votes 2000
+#   python bench_cluster.py compare bench_results/old.json bench_results/new.json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CANDIDATES = ["candidate_" + str(i) for i in range(5)]
+
+
+def make_votes(count):
+    votes = []
+    for i in range(count):
+        sk = SigningKey.generate(curve=NIST384p)
+        vote = CANDIDATES[i % len(CANDIDATES)]
+        votes.append({"pub_key" : sk.verifying_key.to_string().hex(),
+                      "vote" : vote,
+                      "sign" : sk.sign(vote.encode()).hex()})
+    return votes
+
+
+def make_corpus(count, workers):
+    # Key generation and signing dominate, so the corpus is built in parallel
+    chunks = [count // workers + (1 if i < count % workers else 0) for i in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return [vote for chunk in pool.map(make_votes, chunks) for vote in chunk]
+
+
+def address(port):
+    return "http://localhost:" + str(port)
+
+
+def start_node(port, data_dir, env):
+    log = open(os.path.join(data_dir, "node%d.log" % port), "w")
+    process = subprocess.Popen([sys.executable, "bc_py3.py", str(port)], cwd=HERE, stdout=log, stderr=subprocess.STDOUT,
+                               env=dict(os.environ, VOTE_DATA_DIR=data_dir, VOTE_DEBUG="0", **env))
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(address(port) + "/get_peers", timeout=1)
+            return process
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                raise RuntimeError("Node on port %d exited, see its log in %s" % (port, data_dir))
+            time.sleep(0.1)
+    raise RuntimeError("Node on port %d did not start" % port)
+
+
+def register(port, peer_port):
+    response = requests.post(address(port) + "/register_with", json={"node_address": address(peer_port)})
+    response.raise_for_status()
+
+
+def chain_length(port):
+    return requests.get(address(port) + "/get_chain", params={"from": 0, "limit": 0}).json()["length"]
+
+
+def pool_size(port):
+    return requests.get(address(port) + "/mempool_stats").json()["count"]
+
+
+def memory_mb(process):
+    # Resident set size from /proc, None where that is not available
+    try:
+        with open("/proc/%d/status" % process.pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def replay(ports, votes, concurrency):
+    # Votes go round-robin over the nodes from `concurrency` client threads
+    sessions = {}
+
+    def send(position):
+        session = sessions.setdefault(position % concurrency, requests.Session())
+        port = ports[position % len(ports)]
+        return session.post(address(port) + "/new_transaction", json=votes[position]).status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        statuses = list(pool.map(send, range(len(votes))))
+    elapsed = time.perf_counter() - start
+    accepted = statuses.count(201)
+    return {"accepted": accepted,
+            "rejected": len(statuses) - accepted,
+            "seconds": elapsed,
+            "votes_per_sec": accepted / elapsed if elapsed else 0.0}
+
+
+def propagate(ports, timeout):
+    # Seals blocks on the first node until every vote is on the chain and
+    # times how long each block takes to reach a majority of the nodes
+    quorum = len(ports) // 2 + 1
+    latencies = []
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        target = chain_length(ports[0]) + 1
+        start = time.perf_counter()
+        response = requests.get(address(ports[0]) + "/propose_block")
+        if not response.text.startswith("{"):
+            if sum(pool_size(port) for port in ports) == 0:
+                break
+            time.sleep(0.2)  # votes still on their way to the proposer
+            continue
+        while time.time() < deadline:
+            if sum(chain_length(port) >= target for port in ports) >= quorum:
+                latencies.append(time.perf_counter() - start)
+                break
+            time.sleep(0.005)
+    latencies.sort()
+    return {"blocks": len(latencies),
+            "quorum": quorum,
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": latencies[len(latencies) // 2] if latencies else None,
+            "max": latencies[-1] if latencies else None}
+
+
+def run(args):
+    ports = [args.base_port + i for i in range(args.nodes)]
+    late_port = args.base_port + args.nodes
+    env = {"VOTE_AUTO_SEAL": "0", "VOTE_MAX_BLOCK_TXNS": str(args.block_size)}
+    processes = {}
+    data_dir = tempfile.mkdtemp(prefix="vote-bench-")
+    results = {"config": vars(args), "started": time.strftime("%Y-%m-%dT%H:%M:%S"), "data_dir": data_dir}
+    try:
+        start = time.perf_counter()
+        votes = make_corpus(args.votes, args.workers)
+        results["corpus_seconds"] = time.perf_counter() - start
+
+        for port in ports:
+            processes[port] = start_node(port, data_dir, env)
+        requests.get(address(ports[0]) + "/create_genesis_block").raise_for_status()
+        for i, port in enumerate(ports):
+            for peer_port in ports[:i]:
+                register(port, peer_port)
+
+        results["replay"] = replay(ports, votes, args.concurrency)
+        results["propagation"] = propagate(ports, args.timeout)
+        results["chain_length"] = {str(port): chain_length(port) for port in ports}
+
+        processes[late_port] = start_node(late_port, data_dir, env)
+        start = time.perf_counter()
+        register(late_port, ports[0])
+        results["late_joiner"] = {"sync_seconds": time.perf_counter() - start,
+                                  "chain_length": chain_length(late_port)}
+        results["memory_rss_mb"] = {str(port): memory_mb(process) for port, process in processes.items()}
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print("Results written to", args.out)
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(paths):
+    runs = []
+    for path in paths:
+        with open(path) as f:
+            runs.append(flatten(json.load(f)))
+    metrics = sorted(set().union(*runs))
+    print("%-32s" % "metric" + "".join("%16s" % os.path.basename(path)[:15] for path in paths))
+    for metric in metrics:
+        print("%-32s" % metric + "".join("%16s" % ("%.4g" % run[metric] if metric in run else "-") for run in runs))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        compare(sys.argv[2:])
+        sys.exit()
+    parser = argparse.ArgumentParser(description="Local multi-node benchmark")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--votes", type=int, default=2000)
+    parser.add_argument("--block-size", type=int, default=500)
+    parser.add_argument("--base-port", type=int, default=5600)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--out", default=os.path.join("bench_results", time.strftime("cluster-%Y%m%d-%H%M%S.json")))
+    run(parser.parse_args())
@@ -0,0 +1,60 @@
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from transaction_table import TransactionTable
+
+# Usage: python bench_memory.py [votes] [votes_per_block]
+# Memory held by a chain of blocks, with one dict of hex strings per vote in
+# a regular object as before, and with slotted blocks over packed tables.
+# Keys and signatures are random bytes of the real sizes, no signing needed.
+VOTES = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+PER_BLOCK = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+CANDIDATES = 5
+
+
+class DictBlock:
+    def __init__(self, index, transactions):
+        self.index = index
+        self.transactions = transactions
+        self.proof_of_verification = os.urandom(48).hex()
+        self.timestamp = time.time()
+        self.previous_hash = os.urandom(32).hex()
+        self.merkle_root = os.urandom(32).hex()
+        self.hash = os.urandom(32).hex()
+
+
+class SlotBlock(DictBlock):
+    __slots__ = ('index', 'transactions', 'proof_of_verification', 'timestamp', 'previous_hash', 'merkle_root', 'hash')
+
+
+def make_transactions(start, count):
+    # Fresh strings per vote, as they arrive from JSON
+    return {str(5000) + str(start + i): {
+                "pub_key" : os.urandom(96).hex(),
+                "vote" : "".join(["candidate_", str((start + i) % CANDIDATES)]),
+                "timestamp" : time.time(),
+                "sign" : os.urandom(96).hex()
+            } for i in range(count)}
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    chain = []
+    for index, start in enumerate(range(0, VOTES, PER_BLOCK)):
+        chain.append(build(index, make_transactions(start, min(PER_BLOCK, VOTES - start))))
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used
+
+
+before = measure(lambda index, transactions: DictBlock(index, transactions))
+after = measure(lambda index, transactions: SlotBlock(index, TransactionTable.pack(transactions)))
+scale = 1000000 / VOTES
+print("%d votes in blocks of %d" % (VOTES, PER_BLOCK))
+print("%8s %14s %12s" % ("layout", "MB/M votes", "bytes/vote"))
+print("%8s %14.1f %12.0f" % ("dicts", before * scale / 2 ** 20, before / VOTES))
+print("%8s %14.1f %12.0f" % ("packed", after * scale / 2 ** 20, after / VOTES))
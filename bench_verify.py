@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+from ecdsa import SigningKey, NIST384p
+import utils
+
+# Usage: python bench_verify.py [number_of_votes]
+VOTES = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+VOTERS = 50
+
+
+def make_votes(count):
+    keys = [SigningKey.generate(curve=NIST384p) for _ in range(VOTERS)]
+    votes = []
+    for i in range(count):
+        sk = keys[i % VOTERS]
+        vote = "candidate_" + str(i % 5)
+        votes.append({
+                "pub_key" : sk.verifying_key.to_string().hex(),
+                "vote" : vote,
+                "timestamp" : time.time(),
+                "sign" : sk.sign(vote.encode()).hex()
+            })
+    # Tamper with a few votes so the failed indices are exercised as well
+    for i in range(0, count, 500):
+        votes[i]["vote"] = "tampered"
+    return votes
+
+
+votes = make_votes(VOTES)
+# Signed by other keys, so warming a pool up does not cache the measured voters' keys
+warm_up_votes = make_votes(utils.PARALLEL_VERIFY_THRESHOLD)
+expected = set(range(0, VOTES, 500))
+
+worker_counts = sorted({1, 2, 4, 8, os.cpu_count() or 1})
+baseline = None
+print("votes: %d, cpus: %d" % (VOTES, os.cpu_count() or 1))
+print("%8s %10s %12s %8s" % ("workers", "seconds", "votes/sec", "speedup"))
+for workers in worker_counts:
+    # Warm the pool up so process start-up is not part of the measurement, and
+    # start every configuration with the same cold key cache
+    utils.verify_transactions(warm_up_votes, workers=workers)
+    utils.key_cache.clear()
+    start = time.perf_counter()
+    failed = utils.verify_transactions(votes, workers=workers)
+    elapsed = time.perf_counter() - start
+    assert set(failed) == expected
+    baseline = baseline or elapsed
+    print("%8d %10.2f %12.0f %7.2fx" % (workers, elapsed, VOTES / elapsed, baseline / elapsed))
@@ -0,0 +1,54 @@
+import json
+import sys
+import time
+import zlib
+from ecdsa import SigningKey, NIST384p
+import merkle
+import utils
+import wire
+
+# Usage: python bench_wire.py [votes_per_block]
+VOTES = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+ROUNDS = 5
+
+
+def make_block(count):
+    sk = SigningKey.generate(curve=NIST384p)
+    pub_key = sk.verifying_key.to_string().hex()
+    transactions = {}
+    for i in range(count):
+        vote = "candidate_" + str(i % 5)
+        transactions["5000" + str(i + 1)] = {
+                "pub_key" : pub_key,
+                "vote" : vote,
+                "timestamp" : time.time(),
+                "sign" : sk.sign(vote.encode()).hex()
+            }
+    header = utils.block_header(1, time.time(), "ab" * 32, merkle.merkle_root(transactions))
+    block = dict(header, transactions=transactions, proof_of_verification=utils.sign_header(header))
+    block["hash"] = utils.hash_header(header)
+    return block
+
+
+def timed(fn, arg):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        result = fn(arg)
+    return result, (time.perf_counter() - start) / ROUNDS
+
+
+block = make_block(VOTES)
+formats = [
+    ("json", lambda b: json.dumps(b).encode(), lambda p: json.loads(p)),
+    ("json+zlib", lambda b: zlib.compress(json.dumps(b).encode()), lambda p: json.loads(zlib.decompress(p))),
+    ("wire", lambda b: wire.encode_block(b, compress=False), wire.decode),
+    ("wire+zlib", lambda b: wire.encode_block(b, compress=True), wire.decode),
+]
+
+print("block with %d votes" % VOTES)
+print("%10s %12s %12s %12s" % ("format", "bytes", "encode ms", "decode ms"))
+for name, encode, decode in formats:
+    payload, encode_time = timed(encode, block)
+    decoded, decode_time = timed(decode, payload)
+    assert decoded == block
+    print("%10s %12d %12.2f %12.2f" % (name, len(payload), encode_time * 1000, decode_time * 1000))
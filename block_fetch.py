@@ -0,0 +1,114 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+class BlockFetcher:
+    # Downloads advertised blocks in the background, up to max_workers at a
+    # time. A block id is only fetched once at a time: adverts for a block
+    # already in flight just add their peer as another source to try should
+    # the download fail. fetch(peer, block_id) returns a verified block or
+    # None; deliver(block, peer) is called with each block fetched.
+
+    def __init__(self, fetch, deliver, max_workers=4):
+        self.fetch = fetch
+        self.deliver = deliver
+        self.max_workers = max_workers
+        self.fetched = 0
+        self.failed = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def request(self, block_id, peer):
+        # Returns True if this started a download
+        with self._lock:
+            peers = self._in_flight.get(block_id)
+            if peers is not None:
+                if peer not in peers:
+                    peers.append(peer)
+                return False
+            self._in_flight[block_id] = [peer]
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="block-fetch")
+        self._pool.submit(tracing.bind(self._run), block_id)
+        return True
+
+    def _next_peer(self, block_id, tried):
+        with self._lock:
+            peers = self._in_flight[block_id]
+            if tried < len(peers):
+                return peers[tried]
+            del self._in_flight[block_id]
+            self.failed += 1
+            return None
+
+    def _run(self, block_id):
+        tried = 0
+        while True:
+            peer = self._next_peer(block_id, tried)
+            if peer is None:
+                return
+            tried += 1
+            try:
+                block = self.fetch(peer, block_id)
+            except Exception:
+                logger.exception("Fetching block %s from %s failed", block_id, peer)
+                block = None
+            if block is not None:
+                break
+        try:
+            self.deliver(block, peer)
+        except Exception:
+            logger.exception("Handling fetched block %s failed", block_id)
+        finally:
+            with self._lock:
+                del self._in_flight[block_id]
+                self.fetched += 1
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._in_flight), "fetched": self.fetched, "failed": self.failed,
+                    "max_workers": self.max_workers}
+
+
+class OrphanBuffer:
+    # Blocks that are ready to go on the chain but whose parent has not been
+    # added yet, looked up by parent hash. Beyond max_blocks the oldest go.
+
+    def __init__(self, max_blocks=100):
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict()
+        self._children = {}
+
+    def add(self, block):
+        if block.hash in self._blocks:
+            return
+        self._blocks[block.hash] = block
+        self._children.setdefault(block.previous_hash, []).append(block.hash)
+        while len(self._blocks) > self.max_blocks:
+            self._remove(next(iter(self._blocks)))
+
+    def _remove(self, block_hash):
+        block = self._blocks.pop(block_hash)
+        children = self._children[block.previous_hash]
+        children.remove(block_hash)
+        if not children:
+            del self._children[block.previous_hash]
+        return block
+
+    def waiting_on(self, block_hash):
+        # Whether some orphan has this block as its parent
+        return block_hash in self._children
+
+    def take(self, parent_hash):
+        # Removes and returns the oldest orphan whose parent is parent_hash
+        children = self._children.get(parent_hash)
+        return self._remove(children[0]) if children else None
+
+    def __len__(self):
+        return len(self._blocks)
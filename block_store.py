@@ -0,0 +1,262 @@
+import json
+import mmap
+import os
+import struct
+import threading
+
+# On-disk layout of a node's chain, one directory per node:
+#   blocks.dat  length-prefixed JSON block records, append only
+#   blocks.idx  header + one fixed-size entry per block index (offset, length, hash)
+#   hashes.idx  open-addressing table from block hash to block index
+# Both index files are memory-mapped, so reopening a store is constant time.
+# One process appends; others can open the same store read-only and follow
+# it, since an append only becomes visible once the block count is updated.
+
+RECORD_PREFIX = struct.Struct('<I')
+INDEX_HEADER = struct.Struct('<8sQQ')       # magic, block count, sequence number
+INDEX_ENTRY = struct.Struct('<QI32s')       # offset, length, raw block hash
+HASH_HEADER = struct.Struct('<8sQQ')        # magic, capacity, used slots
+HASH_SLOT = struct.Struct('<32sQ')          # raw block hash, block index + 1 (0 marks an empty slot)
+
+INDEX_MAGIC = b'VOTEIDX1'
+HASH_MAGIC = b'VOTEHSH1'
+INITIAL_BLOCKS = 1024
+INITIAL_SLOTS = 2048
+
+
+def _raw_hash(block_hash):
+    raw = bytes.fromhex(block_hash)
+    if len(raw) != 32:
+        raise ValueError("Block hash must be a hex encoded sha256 digest")
+    return raw
+
+
+def _slot_of(raw_hash, capacity):
+    return int.from_bytes(raw_hash[:8], 'little') & (capacity - 1)
+
+
+class _MappedFile:
+    def __init__(self, path, magic, initial_size, readonly=False):
+        self.readonly = readonly
+        if readonly:
+            self.file = open(path, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.map[:len(magic)] != magic:
+                raise ValueError("%s is not a block store index" % path)
+            return
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a+b')
+        if new:
+            self.file.truncate(initial_size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        if new:
+            self.map[:len(magic)] = magic
+        elif self.map[:len(magic)] != magic:
+            raise ValueError("%s is not a block store index" % path)
+
+    def refresh(self):
+        # Maps the file again after another process grew it. The old map is
+        # left for the garbage collector, other threads may still be reading it.
+        if os.fstat(self.file.fileno()).st_size != len(self.map):
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE)
+
+    def ensure(self, size):
+        if size <= len(self.map):
+            return
+        new_size = len(self.map)
+        while new_size < size:
+            new_size *= 2
+        # Like refresh, the old map stays open for threads still reading it
+        self.file.truncate(new_size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class BlockStore:
+    def __init__(self, path, decode, encode=vars, readonly=False):
+        self.path = path
+        self.decode = decode
+        self.encode = encode
+        self.readonly = readonly
+        self._lock = threading.RLock()
+        self._last = None
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+        self._index = _MappedFile(os.path.join(path, 'blocks.idx'), INDEX_MAGIC,
+                                  INDEX_HEADER.size + INITIAL_BLOCKS * INDEX_ENTRY.size, readonly)
+        self._hashes = _MappedFile(os.path.join(path, 'hashes.idx'), HASH_MAGIC,
+                                   HASH_HEADER.size + INITIAL_SLOTS * HASH_SLOT.size, readonly)
+        if readonly:
+            self._data = open(os.path.join(path, 'blocks.dat'), 'rb')
+            return
+        if self._hash_header()[1] == 0:
+            HASH_HEADER.pack_into(self._hashes.map, 0, HASH_MAGIC, INITIAL_SLOTS, 0)
+
+        # Not opened for appending: records are written at the end of the
+        # last indexed one, which an append mode write would ignore
+        self._data = open(os.open(os.path.join(path, 'blocks.dat'), os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        # Drop a record that was being written when the node stopped
+        end = self._end_offset()
+        if os.fstat(self._data.fileno()).st_size > end:
+            self._data.truncate(end)
+
+    def _header(self):
+        return INDEX_HEADER.unpack_from(self._index.map, 0)
+
+    def _hash_header(self):
+        return HASH_HEADER.unpack_from(self._hashes.map, 0)
+
+    def _entry(self, index):
+        position = INDEX_HEADER.size + index * INDEX_ENTRY.size
+        if position + INDEX_ENTRY.size > len(self._index.map):
+            self._index.refresh()
+        return INDEX_ENTRY.unpack_from(self._index.map, position)
+
+    def _end_offset(self):
+        count = len(self)
+        if not count:
+            return 0
+        offset, length, _ = self._entry(count - 1)
+        return offset + RECORD_PREFIX.size + length
+
+    def __len__(self):
+        return self._header()[1]
+
+    @property
+    def sequence_number(self):
+        # Last transaction sequence number handed out by the node, kept here
+        # so transaction ids are not reused after a restart
+        return self._header()[2]
+
+    @sequence_number.setter
+    def sequence_number(self, value):
+        with self._lock:
+            INDEX_HEADER.pack_into(self._index.map, 0, INDEX_MAGIC, len(self), value)
+
+    def record_size(self, index):
+        # Bytes of the block's stored JSON
+        return self._entry(index)[1]
+
+    def hash_at(self, index):
+        return self._entry(index)[2].hex()
+
+    def raw(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("block index out of range")
+        offset, length, _ = self._entry(index)
+        return os.pread(self._data.fileno(), length, offset + RECORD_PREFIX.size).decode()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        count = len(self)
+        if index < 0:
+            index += count
+        # The tip is read on every add and seal check, so it is kept decoded.
+        # Another process may have replaced it since, which its hash shows.
+        last = self._last
+        if last is not None and last[0] == index < count and self._entry(index)[2] == last[1]:
+            return last[2]
+        block = self.decode(json.loads(self.raw(index)))
+        if index == count - 1:
+            self._last = (index, self._entry(index)[2], block)
+        return block
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def index_of_hash(self, block_hash):
+        try:
+            raw_hash = _raw_hash(block_hash)
+        except (ValueError, TypeError):
+            return None
+        _, capacity, _ = self._hash_header()
+        if HASH_HEADER.size + capacity * HASH_SLOT.size > len(self._hashes.map):
+            self._hashes.refresh()
+        slot = _slot_of(raw_hash, capacity)
+        count = len(self)
+        while True:
+            stored, position = HASH_SLOT.unpack_from(self._hashes.map, HASH_HEADER.size + slot * HASH_SLOT.size)
+            if position == 0:
+                return None
+            # Slots left behind by a write that never completed point past the end
+            if stored == raw_hash and position - 1 < count and self._entry(position - 1)[2] == raw_hash:
+                return position - 1
+            slot = (slot + 1) & (capacity - 1)
+
+    def _insert_hash(self, raw_hash, index):
+        _, capacity, used = self._hash_header()
+        if (used + 1) * 2 > capacity:
+            # Every block below index is in the index, published or not yet
+            self._rebuild_hashes(capacity * 2, index)
+            _, capacity, used = self._hash_header()
+        slot = _slot_of(raw_hash, capacity)
+        while HASH_SLOT.unpack_from(self._hashes.map, HASH_HEADER.size + slot * HASH_SLOT.size)[1] != 0:
+            slot = (slot + 1) & (capacity - 1)
+        HASH_SLOT.pack_into(self._hashes.map, HASH_HEADER.size + slot * HASH_SLOT.size, raw_hash, index + 1)
+        HASH_HEADER.pack_into(self._hashes.map, 0, HASH_MAGIC, capacity, used + 1)
+
+    def _rebuild_hashes(self, capacity, count):
+        self._hashes.ensure(HASH_HEADER.size + capacity * HASH_SLOT.size)
+        self._hashes.map[HASH_HEADER.size:] = bytes(len(self._hashes.map) - HASH_HEADER.size)
+        HASH_HEADER.pack_into(self._hashes.map, 0, HASH_MAGIC, capacity, 0)
+        for index in range(count):
+            self._insert_hash(self._entry(index)[2], index)
+
+    def append(self, block):
+        self.extend([block])
+
+    def extend(self, blocks):
+        with self._lock:
+            count = index = len(self)
+            offset = self._end_offset()
+            for block in blocks:
+                raw_hash = _raw_hash(block.hash)
+                record = json.dumps(self.encode(block)).encode()
+                os.pwrite(self._data.fileno(), RECORD_PREFIX.pack(len(record)) + record, offset)
+                self._index.ensure(INDEX_HEADER.size + (index + 1) * INDEX_ENTRY.size)
+                INDEX_ENTRY.pack_into(self._index.map, INDEX_HEADER.size + index * INDEX_ENTRY.size,
+                                      offset, len(record), raw_hash)
+                self._insert_hash(raw_hash, index)
+                offset += RECORD_PREFIX.size + len(record)
+                index += 1
+            if index == count:
+                return
+            # Publishing the new count is the commit point. The records and
+            # their entries are on disk first, so not even a power loss leaves
+            # the count covering a block that was never stored.
+            self.flush()
+            INDEX_HEADER.pack_into(self._index.map, 0, INDEX_MAGIC, index, self.sequence_number)
+            self._last = (index - 1, raw_hash, block)
+
+    def truncate(self, length):
+        with self._lock:
+            if length >= len(self):
+                return
+            # The shorter count is on disk before the records it dropped go
+            INDEX_HEADER.pack_into(self._index.map, 0, INDEX_MAGIC, length, self.sequence_number)
+            self._index.map.flush()
+            self._data.truncate(self._end_offset())
+            _, capacity, _ = self._hash_header()
+            self._rebuild_hashes(capacity, length)
+            self._last = None
+
+    def flush(self):
+        with self._lock:
+            self._data.flush()
+            os.fsync(self._data.fileno())
+            self._index.map.flush()
+            self._hashes.map.flush()
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._index.close()
+            self._hashes.close()
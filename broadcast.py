@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import gossip_sent, peer_seconds
+import tracing
+
+
+class Broadcaster:
+    # Sends gossip to peers over one keep-alive session per peer. Posts to
+    # different peers run concurrently, each bounded by its own timeout, and
+    # every post is recorded in per-peer latency/failure stats.
+
+    def __init__(self, timeout=5.0, max_workers=16, tracer=None):
+        self.timeout = timeout
+        self.tracer = tracer
+        self.max_workers = max_workers
+        self._posts = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="broadcast")
+        # Background tasks get their own pool: they wait on posts, and sharing
+        # one pool could leave every thread waiting on posts that never start
+        self._tasks = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gossip")
+        self._sessions = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _session(self, peer):
+        with self._lock:
+            session = self._sessions.get(peer)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["Content-Type"] = "application/json"
+                self._sessions[peer] = session
+            return session
+
+    def _record(self, peer, path, latency, error=None):
+        peer_seconds.observe(latency, path)
+        gossip_sent.inc(path, "ok" if error is None else "error")
+        with self._lock:
+            stats = self._stats.setdefault(peer, {"sent": 0, "failures": 0, "last_latency": None,
+                                                  "avg_latency": None, "last_error": None})
+            stats["sent"] += 1
+            stats["last_latency"] = latency
+            # Exponentially weighted, so one slow post does not dominate the figure
+            if stats["avg_latency"] is None:
+                stats["avg_latency"] = latency
+            else:
+                stats["avg_latency"] = 0.8 * stats["avg_latency"] + 0.2 * latency
+            if error is not None:
+                stats["failures"] += 1
+                stats["last_error"] = error
+
+    def post(self, peer, path, data, timeout=None, headers=None):
+        # Returns the response, or None if the peer could not be reached.
+        # Bytes are sent as they are, anything else as JSON. Traced posts get
+        # their own client span, which the peer's span hangs off.
+        with self.tracer.span("POST " + path, kind="client", peer=peer) if self.tracer else nullcontext() as span:
+            if span is not None:
+                headers = dict(headers or {}, **tracing.headers(span))
+            response = self._post(peer, path, data, timeout, headers)
+            if span is not None:
+                span["attributes"]["status"] = response.status_code if response is not None else None
+            return response
+
+    def _post(self, peer, path, data, timeout, headers):
+        start = time.perf_counter()
+        body = data if isinstance(data, bytes) else json.dumps(data)
+        try:
+            response = self._session(peer).post(peer + path, data=body, headers=headers,
+                                                timeout=timeout or self.timeout)
+        except requests.RequestException as e:
+            self._record(peer, path, time.perf_counter() - start, type(e).__name__)
+            return None
+        error = None if response.ok else "HTTP %d" % response.status_code
+        self._record(peer, path, time.perf_counter() - start, error)
+        return response
+
+    def post_all(self, peers, path, data, timeout=None):
+        # Posts to every peer at once and returns {peer: response or None}
+        return self.post_each({peer: (path, data) for peer in peers}, timeout)
+
+    def post_each(self, posts, timeout=None):
+        # Like post_all, but with a different {peer: (path, data[, headers])} for each peer
+        futures = {peer: self._posts.submit(tracing.bind(self.post), peer, post[0], post[1], timeout, *post[2:])
+                   for peer, post in posts.items()}
+        wait(futures.values())
+        return {peer: future.result() for peer, future in futures.items()}
+
+    def submit(self, fn, *args, **kwargs):
+        # Runs fn in the background so request handlers can return straight away
+        return self._tasks.submit(tracing.bind(fn), *args, **kwargs)
+
+    def forget(self, peer):
+        with self._lock:
+            session = self._sessions.pop(peer, None)
+            self._stats.pop(peer, None)
+        if session is not None:
+            session.close()
+
+    def stats(self):
+        with self._lock:
+            return {peer: dict(stats) for peer, stats in self._stats.items()}
@@ -0,0 +1,89 @@
+import bisect
+import json
+import os
+import threading
+
+# Lookups into the chain without scanning it: block hash to position,
+# transaction id to the position of the block holding it, and block
+# timestamps kept sorted for time-range queries. Blocks are added as they
+# are appended and removed as they come off the tip. Snapshots let a node
+# with a block store resume them instead of reading back the whole chain.
+
+
+class ChainIndex:
+    def __init__(self, track_hashes=True):
+        # A block store already has an on-disk hash table, so the hash map
+        # is only kept for in-memory chains
+        self.track_hashes = track_hashes
+        self._hashes = {}
+        self._transactions = {}
+        self._times = []
+        self._time_blocks = []
+        self._lock = threading.Lock()
+
+    def add(self, block):
+        with self._lock:
+            if self.track_hashes:
+                self._hashes[block.hash] = block.index
+            for transaction_id in block.transactions:
+                self._transactions[transaction_id] = block.index
+            # Proposers' clocks differ, so blocks are not always in time order
+            timestamp = float(block.timestamp)
+            position = bisect.bisect_right(self._times, timestamp)
+            self._times.insert(position, timestamp)
+            self._time_blocks.insert(position, block.index)
+
+    def remove(self, block):
+        with self._lock:
+            if self._hashes.get(block.hash) == block.index:
+                del self._hashes[block.hash]
+            for transaction_id in block.transactions:
+                if self._transactions.get(transaction_id) == block.index:
+                    del self._transactions[transaction_id]
+            timestamp = float(block.timestamp)
+            position = bisect.bisect_left(self._times, timestamp)
+            while position < len(self._times) and self._times[position] == timestamp:
+                if self._time_blocks[position] == block.index:
+                    del self._times[position]
+                    del self._time_blocks[position]
+                    break
+                position += 1
+
+    def block_of_hash(self, block_hash):
+        return self._hashes.get(block_hash)
+
+    def block_of_transaction(self, transaction_id):
+        return self._transactions.get(transaction_id)
+
+    def blocks_between(self, since=None, until=None, limit=None):
+        # Positions of the blocks with since <= timestamp <= until, oldest first
+        with self._lock:
+            start = 0 if since is None else bisect.bisect_left(self._times, since)
+            end = len(self._times) if until is None else bisect.bisect_right(self._times, until)
+            if limit is not None:
+                end = min(end, start + max(limit, 0))
+            return self._time_blocks[start:end]
+
+    def snapshot(self, height, tip):
+        # Snapshot for the chain up to height, whose last block is tip. The
+        # hash map is not kept, it is only used without a block store.
+        with self._lock:
+            return {"height": height, "tip": tip, "transactions": dict(self._transactions),
+                    "times": list(self._times), "time_blocks": list(self._time_blocks)}
+
+    @staticmethod
+    def write(path, snapshot):
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        # Returns (index, height, tip)
+        with open(path) as f:
+            snapshot = json.load(f)
+        index = cls(track_hashes=False)
+        index._transactions = snapshot["transactions"]
+        index._times = snapshot["times"]
+        index._time_blocks = snapshot["time_blocks"]
+        return index, snapshot["height"], snapshot["tip"]
@@ -0,0 +1,100 @@
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+# Syncs a fresh node against a scripted peer that serves forged chains
+# around a validly signed checkpoint, and checks that nothing taken on the
+# checkpoint's word survives unless the checkpointed block really arrives:
+#   python check_sync.py
+
+PEER_PORT = 5990
+PEER_URL = "http://localhost:%d" % PEER_PORT
+DATA_DIR = tempfile.mkdtemp(prefix="vote-check-")
+os.environ.update(VOTE_DATA_DIR=DATA_DIR, VOTE_AUTO_SEAL="0", VOTE_DEBUG="0", VOTE_SYNC_PAGE_SIZE="2",
+                  VOTE_CHECKPOINTS=os.path.join(DATA_DIR, "checkpoints.json"))
+sys.argv = [sys.argv[0], "5989"]
+
+import bc_py3
+import utils
+
+peer = Flask("peer")
+served = {}
+
+
+@peer.route('/checkpoint')
+def checkpoint():
+    return jsonify(served["checkpoint"])
+
+
+@peer.route('/get_chain')
+def get_chain():
+    start = request.args.get('from', 0, type=int)
+    limit = request.args.get('limit', type=int)
+    length = served["length"](start)
+    return jsonify({"length": length, "from": start, "chain": served["chain"][start:min(start + limit, length)]})
+
+
+def make_block(previous, votes, signed):
+    block = bc_py3.Block(index=previous["index"] + 1,
+                         transactions={"x%d" % i: {"pub_key": "00", "vote": vote, "timestamp": time.time(), "sign": "00"}
+                                       for i, vote in enumerate(votes)},
+                         proof_of_verification="00",
+                         timestamp=time.time(),
+                         previous_hash=previous["hash"])
+    if signed:
+        block.proof_of_verification = utils.sign_header(block.header())
+    block.hash = block.compute_hash()
+    return block.to_dict()
+
+
+def make_chain(genesis, count, signed):
+    chain = [genesis]
+    for _ in range(count):
+        chain.append(make_block(chain[-1], ["MALLORY"], signed))
+    return chain
+
+
+def sync(chain, checkpoint, length=None):
+    served.update(chain=chain, checkpoint=checkpoint, length=length or (lambda start: len(chain)))
+    bc_py3.blockchain.truncate(1)
+    try:
+        bc_py3.sync_chain(PEER_URL)
+        outcome = "synced"
+    except Exception:
+        outcome = "rejected"
+    return outcome, len(bc_py3.blockchain.chain), bc_py3.blockchain.tally.results()["counts"]
+
+
+def check(name, result, expected):
+    print("%-58s %s" % (name, "ok" if result == expected else "FAILED: %r, expected %r" % (result, expected)))
+    return result == expected
+
+
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+server = make_server("localhost", PEER_PORT, peer, threaded=True)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+genesis = bc_py3.blockchain.create_genesis_block()
+honest = make_chain(genesis, 10, signed=True)
+replayed = utils.sign_checkpoint(10, honest[10]["hash"])
+
+forged = make_chain(genesis, 5, signed=False)
+results = [
+    check("forged blocks, chain ends before the checkpoint",
+          sync(forged, replayed, length=lambda start: 11), ("rejected", 1, {})),
+    check("forged blocks, length drops below the checkpoint mid-sync",
+          sync(forged, replayed, length=lambda start: 11 if start < 3 else 3), ("rejected", 1, {})),
+    check("forged blocks, checkpointed block does not match",
+          sync(make_chain(genesis, 10, signed=False), replayed), ("rejected", 1, {})),
+    check("honest chain up to and past the checkpoint",
+          sync(honest, replayed), ("synced", 11, {"MALLORY": 10})),
+    check("honest chain shorter than a checkpoint it does not claim",
+          sync(honest[:6], replayed), ("synced", 6, {"MALLORY": 5})),
+]
+server.shutdown()
+sys.exit(0 if all(results) else 1)
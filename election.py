@@ -1,14 +1,65 @@
+import json
+import os
+import threading
+from collections import Counter
+from transaction_table import vote_column
+
+
+class Tally:
+    # Per-candidate vote counts kept in step with the chain: every appended
+    # block is applied and every block removed from the tip is reverted, so
+    # results are always available without reading the chain.
+
+    def __init__(self):
+        self.counts = Counter()
+        self.height = 0
+        self.tip = None
+        self._lock = threading.Lock()
+
+    def apply_block(self, block):
+        with self._lock:
+            self.counts.update(vote_column(block.transactions))
+            self.height = block.index + 1
+            self.tip = block.hash
+
+    def revert_block(self, block):
+        with self._lock:
+            for vote in vote_column(block.transactions):
+                self.counts[vote] -= 1
+                if not self.counts[vote]:
+                    del self.counts[vote]
+            self.height = block.index
+            self.tip = block.previous_hash if block.index > 0 else None
+
+    def results(self):
+        with self._lock:
+            return {"height": self.height,
+                    "total_votes": sum(self.counts.values()),
+                    "counts": dict(self.counts)}
+
+    def save(self, path):
+        with self._lock:
+            snapshot = {"height": self.height, "tip": self.tip, "counts": dict(self.counts)}
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        tally = cls()
+        if os.path.exists(path):
+            with open(path) as f:
+                snapshot = json.load(f)
+            tally.counts = Counter(snapshot["counts"])
+            tally.height = snapshot["height"]
+            tally.tip = snapshot["tip"]
+        return tally
+
+
 class Election:
 
     def __init__(self, host):
         self.host = host
         self.voters = []
         self.blockchain = {}
-
-
-election = Election()
-#  Have to add counting func
-app = Flask(__name__)
-PORT = 5061
-
-
+        self.tally = Tally()
@@ -0,0 +1,116 @@
+import base64
+import hashlib
+import struct
+
+# Invertible Bloom lookup table over 64-bit keys. The cells are split into
+# HASH_COUNT subtables whose size is a power of two, so a table can be folded
+# down to any smaller power of two: a node keeps one large table up to date
+# and sends a folded copy whose size matches the expected difference.
+
+HASH_COUNT = 3
+CELL = struct.Struct('<iQQ')
+
+
+def key_of(transaction_id):
+    return int.from_bytes(hashlib.sha256(transaction_id.encode()).digest()[:8], 'little')
+
+
+def _hashes(key):
+    digest = hashlib.blake2b(key.to_bytes(8, 'little'), digest_size=8 * (HASH_COUNT + 1)).digest()
+    values = [int.from_bytes(digest[i:i + 8], 'little') for i in range(0, len(digest), 8)]
+    return values[:HASH_COUNT], values[HASH_COUNT]
+
+
+class IBLT:
+    def __init__(self, size, counts=None, keys=None, checks=None):
+        if size & (size - 1):
+            raise ValueError("IBLT size must be a power of two")
+        self.size = size
+        cells = size * HASH_COUNT
+        self.counts = counts if counts is not None else [0] * cells
+        self.keys = keys if keys is not None else [0] * cells
+        self.checks = checks if checks is not None else [0] * cells
+
+    def _update(self, key, delta):
+        positions, check = _hashes(key)
+        for table, position in enumerate(positions):
+            cell = table * self.size + (position & (self.size - 1))
+            self.counts[cell] += delta
+            self.keys[cell] ^= key
+            self.checks[cell] ^= check
+
+    def insert(self, key):
+        self._update(key, 1)
+
+    def remove(self, key):
+        self._update(key, -1)
+
+    def fold(self, size):
+        # Same table as if it had been built with `size` cells per subtable
+        if size > self.size or size & (size - 1):
+            raise ValueError("Can only fold to a smaller power of two")
+        counts, keys, checks = [], [], []
+        for table in range(HASH_COUNT):
+            base = table * self.size
+            folded_counts = self.counts[base:base + size]
+            folded_keys = self.keys[base:base + size]
+            folded_checks = self.checks[base:base + size]
+            for offset in range(base + size, base + self.size, size):
+                for i in range(size):
+                    folded_counts[i] += self.counts[offset + i]
+                    folded_keys[i] ^= self.keys[offset + i]
+                    folded_checks[i] ^= self.checks[offset + i]
+            counts.extend(folded_counts)
+            keys.extend(folded_keys)
+            checks.extend(folded_checks)
+        return IBLT(size, counts, keys, checks)
+
+    def subtract(self, other):
+        if other.size != self.size:
+            raise ValueError("Can only subtract tables of the same size")
+        return IBLT(self.size,
+                    [a - b for a, b in zip(self.counts, other.counts)],
+                    [a ^ b for a, b in zip(self.keys, other.keys)],
+                    [a ^ b for a, b in zip(self.checks, other.checks)])
+
+    def _is_pure(self, cell):
+        return self.counts[cell] in (1, -1) and _hashes(self.keys[cell])[1] == self.checks[cell]
+
+    def decode(self):
+        # Peels a difference table. Returns (keys only in self, keys only in
+        # other), or None if the difference is too large for this size.
+        table = IBLT(self.size, list(self.counts), list(self.keys), list(self.checks))
+        ours, theirs = [], []
+        queue = [cell for cell in range(len(table.counts)) if table._is_pure(cell)]
+        while queue:
+            cell = queue.pop()
+            if not table._is_pure(cell):
+                continue
+            key, count = table.keys[cell], table.counts[cell]
+            (ours if count == 1 else theirs).append(key)
+            table._update(key, -count)
+            positions, _ = _hashes(key)
+            for index, position in enumerate(positions):
+                neighbour = index * table.size + (position & (table.size - 1))
+                if table._is_pure(neighbour):
+                    queue.append(neighbour)
+        if any(table.counts) or any(table.keys):
+            return None
+        return ours, theirs
+
+    def to_json(self):
+        packed = b''.join(CELL.pack(count, key, check)
+                          for count, key, check in zip(self.counts, self.keys, self.checks))
+        return {"size": self.size, "cells": base64.b64encode(packed).decode()}
+
+    @classmethod
+    def from_json(cls, data):
+        packed = base64.b64decode(data["cells"])
+        if len(packed) != CELL.size * HASH_COUNT * data["size"]:
+            raise ValueError("Sketch does not match its size")
+        counts, keys, checks = [], [], []
+        for count, key, check in CELL.iter_unpack(packed):
+            counts.append(count)
+            keys.append(key)
+            checks.append(check)
+        return cls(data["size"], counts, keys, checks)
@@ -0,0 +1,60 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class InventoryBatcher:
+    # Collects new transaction ids and hands them to flush() in batches:
+    # once `window` seconds have passed since the first id of a batch came in,
+    # or as soon as `max_items` ids are waiting, whichever comes first.
+
+    def __init__(self, flush, window=0.2, max_items=1000):
+        self.flush = flush
+        self.window = window
+        self.max_items = max_items
+        self._pending = []
+        self._first_at = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="inventory", daemon=True)
+            self._thread.start()
+
+    def add(self, transaction_id):
+        self.add_many([transaction_id])
+
+    def add_many(self, transaction_ids):
+        with self._cond:
+            self._start()
+            if not self._pending:
+                self._first_at = time.monotonic()
+            self._pending.extend(transaction_ids)
+            self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    remaining = self._first_at + self.window - time.monotonic()
+                    if remaining <= 0 or len(self._pending) >= self.max_items:
+                        batch = self._pending[:self.max_items]
+                        self._pending = self._pending[self.max_items:]
+                        if not self._pending:
+                            self._first_at = None
+                        return batch
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            try:
+                self.flush(batch)
+            except Exception:
+                # A failed announcement must not stop later batches going out
+                logger.exception("Inventory flush of %d transactions failed", len(batch))
@@ -0,0 +1,128 @@
+import itertools
+import sys
+import time
+from collections.abc import MutableMapping
+import iblt
+
+
+def transaction_size(transaction_id, transaction):
+    # Approximate memory held by one pooled vote: the id, the dict and its values
+    return (sys.getsizeof(transaction_id) + sys.getsizeof(transaction)
+            + sum(sys.getsizeof(value) for value in transaction.values()))
+
+
+class Mempool(MutableMapping):
+    # Pending transactions by id, in arrival order. Alongside the dict it keeps
+    # an IBLT sketch of the ids up to date, so reconciling with a peer never
+    # has to walk the whole pool. max_count and max_bytes bound the pool;
+    # when it is full, new votes are refused or, with evict, the oldest go.
+    # With a mirror attached, every change is also written through to it.
+
+    def __init__(self, sketch_size=4096, max_count=None, max_bytes=None, evict=False):
+        self._transactions = {}
+        self._ids_by_key = {}
+        self.sketch = iblt.IBLT(sketch_size)
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.evict = evict
+        self.bytes = 0
+        self._sizes = {}
+        self._arrivals = {}
+        self.mirror = None
+
+    def attach(self, mirror):
+        # Starts writing through to mirror, beginning with the current contents
+        mirror.replace_transactions((transaction_id, transaction, self._sizes[transaction_id])
+                                    for transaction_id, transaction in self._transactions.items())
+        self.mirror = mirror
+
+    def __getitem__(self, transaction_id):
+        return self._transactions[transaction_id]
+
+    def __setitem__(self, transaction_id, transaction):
+        if transaction_id not in self._transactions:
+            key = iblt.key_of(transaction_id)
+            self._ids_by_key[key] = transaction_id
+            self.sketch.insert(key)
+            self._arrivals[transaction_id] = time.monotonic()
+        size = transaction_size(transaction_id, transaction)
+        self.bytes += size - self._sizes.get(transaction_id, 0)
+        self._sizes[transaction_id] = size
+        self._transactions[transaction_id] = transaction
+        if self.mirror is not None:
+            self.mirror.put_transaction(transaction_id, transaction, size)
+
+    def __delitem__(self, transaction_id):
+        del self._transactions[transaction_id]
+        self.bytes -= self._sizes.pop(transaction_id)
+        del self._arrivals[transaction_id]
+        key = iblt.key_of(transaction_id)
+        del self._ids_by_key[key]
+        self.sketch.remove(key)
+        if self.mirror is not None:
+            self.mirror.delete_transaction(transaction_id)
+
+    def __iter__(self):
+        return iter(self._transactions)
+
+    def __len__(self):
+        return len(self._transactions)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._transactions
+
+    def clear(self):
+        self._transactions.clear()
+        self._ids_by_key.clear()
+        self._sizes.clear()
+        self._arrivals.clear()
+        self.bytes = 0
+        self.sketch = iblt.IBLT(self.sketch.size)
+        if self.mirror is not None:
+            self.mirror.replace_transactions([])
+
+    def _over_budget(self, count, size):
+        return ((self.max_count is not None and count > self.max_count)
+                or (self.max_bytes is not None and size > self.max_bytes))
+
+    def has_room(self, transaction_id, transaction):
+        # Whether the vote can go in, counting on eviction when it is enabled
+        if self.evict:
+            return not self._over_budget(1, transaction_size(transaction_id, transaction))
+        return not self._over_budget(len(self) + 1, self.bytes + transaction_size(transaction_id, transaction))
+
+    def make_room(self, transaction_id, transaction):
+        # Evicts the oldest votes until the new one fits and returns them as
+        # (transaction_id, transaction) pairs, or None if it cannot fit
+        if not self.has_room(transaction_id, transaction):
+            return None
+        size = transaction_size(transaction_id, transaction)
+        evicted = []
+        while self._over_budget(len(self) + 1, self.bytes + size):
+            oldest = next(iter(self._transactions))
+            evicted.append((oldest, self._transactions[oldest]))
+            del self[oldest]
+        return evicted
+
+    def oldest(self, count):
+        # Ids of the first count votes in arrival order
+        return list(itertools.islice(self._transactions, count))
+
+    def arrived_at(self, transaction_id):
+        # time.monotonic() when the vote entered the pool
+        return self._arrivals[transaction_id]
+
+    def oldest_age(self):
+        for transaction_id in self._transactions:
+            return time.monotonic() - self._arrivals[transaction_id]
+        return 0.0
+
+    def stats(self):
+        return {"count": len(self), "bytes": self.bytes,
+                "max_count": self.max_count, "max_bytes": self.max_bytes, "evict": self.evict}
+
+    def id_for_key(self, key):
+        return self._ids_by_key.get(key)
+
+    def to_dict(self):
+        return dict(self._transactions)
@@ -0,0 +1,66 @@
+import json
+from hashlib import sha256
+from metrics import crypto_seconds
+
+# Leaves and inner nodes are hashed with different prefixes so an inner node
+# can never be passed off as a transaction.
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def transaction_leaf(transaction_id, transaction):
+    encoded = json.dumps([transaction_id, transaction], sort_keys=True).encode()
+    return sha256(LEAF_PREFIX + encoded).digest()
+
+
+def _hash_pair(left, right):
+    return sha256(NODE_PREFIX + left + right).digest()
+
+
+def _levels(leaves):
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [_hash_pair(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            # An odd node is promoted unchanged rather than paired with itself
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def _leaves(transactions):
+    return [transaction_leaf(transaction_id, transactions[transaction_id])
+            for transaction_id in sorted(transactions)]
+
+
+@crypto_seconds.timed("merkle_root")
+def merkle_root(transactions):
+    leaves = _leaves(transactions)
+    if not leaves:
+        return sha256(b'').hexdigest()
+    return _levels(leaves)[-1][0].hex()
+
+
+@crypto_seconds.timed("merkle_path")
+def merkle_path(transactions, transaction_id):
+    # Returns the sibling hashes from the leaf up to the root, each with the
+    # side it sits on, or None if the transaction is not in the block.
+    if transaction_id not in transactions:
+        return None
+    position = sorted(transactions).index(transaction_id)
+    path = []
+    for level in _levels(_leaves(transactions))[:-1]:
+        sibling = position ^ 1
+        if sibling < len(level):
+            path.append([level[sibling].hex(), "L" if sibling < position else "R"])
+        position //= 2
+    return path
+
+
+def verify_path(transaction_id, transaction, path, root):
+    node = transaction_leaf(transaction_id, transaction)
+    for sibling, side in path:
+        sibling = bytes.fromhex(sibling)
+        node = _hash_pair(sibling, node) if side == "L" else _hash_pair(node, sibling)
+    return node.hex() == root
@@ -0,0 +1,167 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Minimal Prometheus instrumentation: counters, histograms and callback
+# gauges, rendered in the text exposition format. Recording a value is a
+# dict lookup and a few additions under a lock, cheap enough to leave on
+# in production.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + ['%s%s %s' % (self.name, _labels(self.labelnames, labels), _number(value))
+                                for labels, value in values]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, *labels):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def timed(self, *labels):
+        # Decorator form of time()
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *labels)
+            return wrapper
+        return decorate
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items())
+        lines = self.header()
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (self.name, _labels(self.labelnames, labels, [("le", _number(bound))]), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labelnames, labels), _number(total)))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labelnames, labels), count))
+        return lines
+
+
+class Gauge(_Metric):
+    # Read through a callback when scraped, so there is nothing to keep in step
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, read):
+        super().__init__(name, documentation)
+        self.read = read
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception:
+            return self.header()
+        return self.header() + ['%s %s' % (self.name, _number(value))]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+crypto_seconds = registry.histogram("vote_crypto_duration_seconds",
+                                    "Time spent in signing, verification and hashing", ["operation"])
+http_seconds = registry.histogram("vote_http_request_duration_seconds",
+                                  "Time to handle a request, by route", ["endpoint", "method", "status"])
+peer_seconds = registry.histogram("vote_peer_request_duration_seconds",
+                                  "Time waiting on a request to a peer", ["path"])
+gossip_sent = registry.counter("vote_gossip_sent_total", "Messages sent to peers", ["path", "outcome"])
+gossip_received = registry.counter("vote_gossip_received_total", "Messages received from peers", ["endpoint"])
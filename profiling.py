@@ -0,0 +1,106 @@
+import collections
+import sys
+import threading
+import time
+import tracemalloc
+
+# On-demand profiling of a running node. The CPU profile samples every
+# thread's stack at a fixed interval, so it needs no tracing hooks and costs
+# nothing while idle. Threads parked in a known wait are left out unless
+# idle samples are asked for. The memory profile diffs two tracemalloc
+# snapshots taken while tracing is on.
+
+MAX_SECONDS = 60
+SAMPLE_INTERVAL = 0.005
+TOP = 25
+
+# Innermost frames of threads that are waiting rather than working
+IDLE_FRAMES = {("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("thread.py", "_worker"),
+               ("queue.py", "get"), ("selectors.py", "select"), ("socketserver.py", "serve_forever"),
+               ("_reloader.py", "run"), ("socket.py", "readinto"), ("ssl.py", "read")}
+
+_running = threading.Lock()
+
+
+class ProfileBusy(Exception):
+    pass
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "%s:%d(%s)" % (code.co_filename.rsplit("/", 1)[-1], code.co_firstlineno, code.co_name)
+
+
+def _idle(frame):
+    return (frame.f_code.co_filename.rsplit("/", 1)[-1], frame.f_code.co_name) in IDLE_FRAMES
+
+
+def sample_cpu(seconds, interval=SAMPLE_INTERVAL, include_idle=False):
+    # Returns the hottest functions by own and total samples, plus collapsed
+    # stacks ("outer;inner count" per line) for flame graph tools
+    me = threading.get_ident()
+    own, total, stacks = collections.Counter(), collections.Counter(), collections.Counter()
+    samples = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me or (not include_idle and _idle(frame)):
+                continue
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            if not names:
+                continue
+            samples += 1
+            own[names[0]] += 1
+            for name in set(names):
+                total[name] += 1
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return {"mode": "cpu",
+            "seconds": seconds,
+            "interval": interval,
+            "include_idle": include_idle,
+            "samples": samples,
+            "top_own": [{"function": name, "samples": count} for name, count in own.most_common(TOP)],
+            "top_total": [{"function": name, "samples": count} for name, count in total.most_common(TOP)],
+            "collapsed": "\n".join("%s %d" % item for item in stacks.most_common())}
+
+
+def sample_memory(seconds):
+    # Allocation growth by source line over the window, and the largest live allocations
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(16)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+    growth = after.compare_to(before, "lineno")[:TOP]
+    largest = after.statistics("lineno")[:TOP]
+    return {"mode": "memory",
+            "seconds": seconds,
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "growth": [{"line": str(stat.traceback), "size_diff": stat.size_diff, "count_diff": stat.count_diff}
+                       for stat in growth],
+            "largest": [{"line": str(stat.traceback), "size": stat.size, "count": stat.count}
+                        for stat in largest]}
+
+
+def profile(mode, seconds, include_idle=False):
+    # One profile at a time per node; raises ProfileBusy otherwise
+    seconds = min(max(float(seconds), 0.1), MAX_SECONDS)
+    if not _running.acquire(blocking=False):
+        raise ProfileBusy()
+    try:
+        if mode == "memory":
+            return sample_memory(seconds)
+        return sample_cpu(seconds, include_idle=include_idle)
+    finally:
+        _running.release()
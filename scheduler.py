@@ -0,0 +1,116 @@
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class InclusionStats:
+    # Time from a vote entering the pool to it being sealed into a block,
+    # with percentiles over the most recent votes
+
+    def __init__(self, window=10000):
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, delays):
+        with self._lock:
+            for delay in delays:
+                self._recent.append(delay)
+                self.count += 1
+                self.total += delay
+                self.max = max(self.max, delay)
+
+    def stats(self):
+        with self._lock:
+            recent = sorted(self._recent)
+            count, total, longest = self.count, self.total, self.max
+
+        def percentile(p):
+            return recent[min(len(recent) - 1, int(p * len(recent)))] if recent else 0.0
+        return {"count": count,
+                "mean": total / count if count else 0.0,
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": longest}
+
+
+def proposer_for(height, members, overdue_rounds=0):
+    # Members take heights in turn by sorted address. When the chosen
+    # proposer has let the pool go overdue, the turn passes down the list.
+    members = sorted(members)
+    return members[(height + overdue_rounds) % len(members)]
+
+
+class BlockScheduler:
+    # Seals a block once the pool holds `size_threshold` votes or its oldest
+    # vote has waited `max_latency` seconds, whichever comes first, as long
+    # as may_seal() agrees that this node proposes the next height.
+
+    def __init__(self, seal, pool, may_seal, size_threshold=1000, max_latency=2.0, interval=0.1):
+        self.seal = seal
+        self.pool = pool
+        self.may_seal = may_seal
+        self.size_threshold = size_threshold
+        self.max_latency = max_latency
+        self.interval = interval
+        self.sealed = 0
+        self.last_reason = None
+        self._cond = threading.Condition()
+        self._sealing = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="block-scheduler", daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        # Called when votes arrive; starts the scheduler on first use
+        with self._cond:
+            self._start()
+            self._cond.notify()
+
+    @contextmanager
+    def paused(self):
+        # No seal starts while paused; one already running finishes first
+        with self._sealing:
+            yield
+
+    def _due(self):
+        pool = self.pool()
+        if not pool:
+            return None
+        age = pool.oldest_age()
+        if len(pool) >= self.size_threshold:
+            reason = "size"
+        elif age >= self.max_latency:
+            reason = "latency"
+        else:
+            return None
+        return reason if self.may_seal(age) else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.interval)
+            with self._sealing:
+                try:
+                    reason = self._due()
+                    if reason is not None and self.seal():
+                        self.sealed += 1
+                        self.last_reason = reason
+                except Exception:
+                    # A failed seal leaves the votes queued for the next attempt
+                    logger.exception("Sealing a block failed")
+
+    def stats(self):
+        return {"sealed": self.sealed,
+                "last_reason": self.last_reason,
+                "size_threshold": self.size_threshold,
+                "max_latency": self.max_latency}
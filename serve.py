@@ -0,0 +1,104 @@
+import argparse
+import os
+import secrets
+import signal
+import socket
+import sys
+import time
+import urllib.request
+
+# Production serving for one node: a writer process that makes every change
+# to the node's state, and reader workers that all accept connections on the
+# node's port. Readers answer reads from the block store and the shared
+# state (see shared_state.py), check vote signatures themselves and pass
+# everything that changes the node on to the writer, so writes stay in one
+# process while reads and signature checks use every core.
+#   python serve.py <port> [--workers N]
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def listen(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    return sock
+
+
+def start_worker(port, role, sock, env):
+    # Forks a process that imports the node and serves it on the bound socket
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.environ.update(env, VOTE_ROLE=role, VOTE_DEBUG="0")
+        sys.argv = [os.path.join(HERE, "bc_py3.py"), str(port)]
+        sys.path.insert(0, HERE)
+        import bc_py3
+        import utils
+        from werkzeug.serving import make_server
+        utils.start_verify_pool()
+        make_server(sock.getsockname()[0], port, bc_py3.app, threaded=True, fd=sock.fileno()).serve_forever()
+        status = 0
+    finally:
+        os._exit(status)
+
+
+def wait_ready(url, timeout):
+    # The socket is already listening, so this waits in its backlog until the worker serves
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + "/get_peers", timeout=timeout).read()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def serve(port, workers, host="localhost"):
+    public = listen(host, port)
+    internal = listen("127.0.0.1", 0)
+    env = {"VOTE_WRITER_URL": "http://127.0.0.1:%d" % internal.getsockname()[1],
+           "VOTE_WORKER_TOKEN": secrets.token_hex(16)}
+
+    # The writer creates the store and the shared state, readers open them after it is up
+    writer = start_worker(port, "writer", internal, env)
+    if not wait_ready(env["VOTE_WRITER_URL"], 60):
+        os.kill(writer, signal.SIGTERM)
+        sys.exit("The writer did not start")
+    readers = {start_worker(port, "reader", public, env) for _ in range(workers)}
+    print("Serving on %s:%d with %d reader workers" % (host, port, workers), flush=True)
+
+    def stop(signum, frame):
+        for pid in readers | {writer}:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while True:
+        pid, status = os.wait()
+        if pid == writer:
+            print("The writer exited, stopping", flush=True)
+            stop(None, None)
+        if pid in readers:
+            # A reader that died is replaced, the rest keep serving meanwhile
+            readers.discard(pid)
+            time.sleep(1)
+            readers.add(start_worker(port, "reader", public, env))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a node with several worker processes")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    serve(args.port, args.workers)
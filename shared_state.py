@@ -0,0 +1,230 @@
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import Mapping, Set
+
+# Node state shared by the worker processes of one node (see serve.py). The
+# writer process makes every change and mirrors the vote pool, the peers and
+# the pending blocks with their advertisement counts into a SQLite database
+# in WAL mode. Readers open it read-only and see each committed change
+# without ever blocking the writer. The chain itself is shared through the
+# block store files.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_id TEXT NOT NULL UNIQUE,
+    body TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    space TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (space, key)
+);
+"""
+
+
+class SharedState:
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if not readonly:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # A single writer connection; its changes only need to survive
+            # for as long as the node runs, so there is no fsync per commit
+            self._writer = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            self._writer.execute("PRAGMA journal_mode=WAL")
+            self._writer.execute("PRAGMA synchronous=OFF")
+            self._writer.executescript(SCHEMA)
+
+    def _reader(self):
+        # One read-only connection per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect("file:%s?mode=ro" % self.path, uri=True)
+            self._local.connection = connection
+        return connection
+
+    def query(self, sql, *params):
+        if self.readonly:
+            return self._reader().execute(sql, params).fetchall()
+        with self._lock:
+            return self._writer.execute(sql, params).fetchall()
+
+    def write(self, sql, *params):
+        with self._lock:
+            self._writer.execute(sql, params)
+
+    def write_many(self, statements):
+        # (sql, params) pairs committed together
+        with self._lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    self._writer.execute(sql, params)
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+    def put_transaction(self, transaction_id, transaction, size):
+        self.write("INSERT INTO transactions (transaction_id, body, size) VALUES (?, ?, ?) "
+                   "ON CONFLICT (transaction_id) DO UPDATE SET body = excluded.body, size = excluded.size",
+                   transaction_id, json.dumps(transaction), size)
+
+    def delete_transaction(self, transaction_id):
+        self.write("DELETE FROM transactions WHERE transaction_id = ?", transaction_id)
+
+    def replace_transactions(self, items):
+        # items are (transaction_id, transaction, size) in arrival order
+        self.write_many([("DELETE FROM transactions", ())]
+                        + [("INSERT INTO transactions (transaction_id, body, size) VALUES (?, ?, ?)",
+                            (transaction_id, json.dumps(transaction), size))
+                           for transaction_id, transaction, size in items])
+
+    def put_entry(self, space, key, value):
+        self.write("INSERT OR REPLACE INTO entries (space, key, value) VALUES (?, ?, ?)",
+                   space, json.dumps(key), json.dumps(value))
+
+    def delete_entry(self, space, key):
+        self.write("DELETE FROM entries WHERE space = ? AND key = ?", space, json.dumps(key))
+
+    def replace_entries(self, space, items):
+        self.write_many([("DELETE FROM entries WHERE space = ?", (space,))]
+                        + [("INSERT INTO entries (space, key, value) VALUES (?, ?, ?)",
+                            (space, json.dumps(key), json.dumps(value))) for key, value in items])
+
+
+class MirroredDict(dict):
+    # A dict in the writer whose every change is written through to a space
+    # of the shared state; encode turns values into JSON
+    def __init__(self, state, space, items=(), encode=None):
+        super().__init__(items)
+        self.state = state
+        self.space = space
+        self.encode = encode or (lambda value: value)
+        state.replace_entries(space, [(key, self.encode(value)) for key, value in self.items()])
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.state.put_entry(self.space, key, self.encode(value))
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.state.delete_entry(self.space, key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        self.state.delete_entry(self.space, key)
+        return value
+
+    def clear(self):
+        super().clear()
+        self.state.replace_entries(self.space, [])
+
+
+class MirroredSet(set):
+    def __init__(self, state, space, items=()):
+        super().__init__(items)
+        self.state = state
+        self.space = space
+        state.replace_entries(space, [(item, None) for item in self])
+
+    def add(self, item):
+        super().add(item)
+        self.state.put_entry(self.space, item, None)
+
+    def remove(self, item):
+        super().remove(item)
+        self.state.delete_entry(self.space, item)
+
+    def discard(self, item):
+        if item in self:
+            self.remove(item)
+
+    def clear(self):
+        super().clear()
+        self.state.replace_entries(self.space, [])
+
+
+class SharedDict(Mapping):
+    # A reader's view of a MirroredDict; decode turns JSON back into values
+    def __init__(self, state, space, decode=None):
+        self.state = state
+        self.space = space
+        self.decode = decode or (lambda value: value)
+
+    def __getitem__(self, key):
+        rows = self.state.query("SELECT value FROM entries WHERE space = ? AND key = ?", self.space, json.dumps(key))
+        if not rows:
+            raise KeyError(key)
+        return self.decode(json.loads(rows[0][0]))
+
+    def __contains__(self, key):
+        return bool(self.state.query("SELECT 1 FROM entries WHERE space = ? AND key = ?", self.space, json.dumps(key)))
+
+    def __iter__(self):
+        return iter([json.loads(key) for key, in self.state.query("SELECT key FROM entries WHERE space = ?", self.space)])
+
+    def __len__(self):
+        return self.state.query("SELECT COUNT(*) FROM entries WHERE space = ?", self.space)[0][0]
+
+
+class SharedSet(Set):
+    # A reader's view of a MirroredSet
+    def __init__(self, state, space):
+        self.entries = SharedDict(state, space)
+
+    def __contains__(self, item):
+        return item in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SharedPool(Mapping):
+    # A reader's view of the writer's Mempool, in arrival order
+    def __init__(self, state, max_count=None, max_bytes=None, evict=False):
+        self.state = state
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.evict = evict
+
+    def __getitem__(self, transaction_id):
+        rows = self.state.query("SELECT body FROM transactions WHERE transaction_id = ?", transaction_id)
+        if not rows:
+            raise KeyError(transaction_id)
+        return json.loads(rows[0][0])
+
+    def __contains__(self, transaction_id):
+        return bool(self.state.query("SELECT 1 FROM transactions WHERE transaction_id = ?", transaction_id))
+
+    def __iter__(self):
+        return iter([transaction_id for transaction_id, in
+                     self.state.query("SELECT transaction_id FROM transactions ORDER BY seq")])
+
+    def __len__(self):
+        return self.state.query("SELECT COUNT(*) FROM transactions")[0][0]
+
+    @property
+    def bytes(self):
+        return self.state.query("SELECT COALESCE(SUM(size), 0) FROM transactions")[0][0]
+
+    def stats(self):
+        count, size = self.state.query("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM transactions")[0]
+        return {"count": count, "bytes": size,
+                "max_count": self.max_count, "max_bytes": self.max_bytes, "evict": self.evict}
+
+    def to_dict(self):
+        return {transaction_id: json.loads(body) for transaction_id, body in
+                self.state.query("SELECT transaction_id, body FROM transactions ORDER BY seq")}
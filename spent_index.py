@@ -0,0 +1,154 @@
+import hashlib
+import os
+import struct
+import threading
+import numpy as np
+
+# Which voters already have a vote in the mempool or on the chain. Keys are
+# 16-byte digests of the voter's pub_key in an open-addressing table packed
+# into one bytearray, so each voter costs a few dozen bytes rather than a
+# dict entry plus the full hex key.
+
+SLOT = struct.Struct('<16sQ')               # pub_key digest, location (0 marks an empty slot)
+LOCATION_PENDING = 1                        # in the mempool; block n is stored as n + 2
+INITIAL_SLOTS = 1024
+SNAPSHOT_HEADER = struct.Struct('<8sQ32sQQ')   # magic, chain height, raw tip hash, capacity, used slots
+SNAPSHOT_MAGIC = b'VOTESPT1'
+
+PENDING = -1
+
+
+def voter_key(pub_key):
+    return hashlib.blake2b(pub_key.encode(), digest_size=16).digest()
+
+
+class SpentIndex:
+    def __init__(self, capacity=INITIAL_SLOTS):
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self._used = 0
+        self._slots = bytearray(capacity * SLOT.size)
+
+    def __len__(self):
+        return self._used
+
+    def __contains__(self, pub_key):
+        return self.get(pub_key) is not None
+
+    def _find(self, key):
+        # Slot holding key, or the empty slot where it would go
+        mask = self._capacity - 1
+        slot = int.from_bytes(key[:8], 'little') & mask
+        while True:
+            stored, location = SLOT.unpack_from(self._slots, slot * SLOT.size)
+            if location == 0 or stored == key:
+                return slot, location
+            slot = (slot + 1) & mask
+
+    def get(self, pub_key):
+        # PENDING for a vote in the mempool, the block index for a committed
+        # one, None if the voter has not voted
+        with self._lock:
+            _, location = self._find(voter_key(pub_key))
+        if location == 0:
+            return None
+        return PENDING if location == LOCATION_PENDING else location - 2
+
+    def _store(self, key, location):
+        if (self._used + 1) * 2 > self._capacity:
+            self._grow()
+        slot, previous = self._find(key)
+        if previous == 0:
+            self._used += 1
+        SLOT.pack_into(self._slots, slot * SLOT.size, key, location)
+
+    def _grow(self):
+        slots = self._slots
+        self._capacity *= 2
+        self._used = 0
+        self._slots = bytearray(self._capacity * SLOT.size)
+        for offset in range(0, len(slots), SLOT.size):
+            key, location = SLOT.unpack_from(slots, offset)
+            if location:
+                self._store(key, location)
+
+    def _delete(self, slot):
+        # Backward-shift deletion keeps probe chains intact without tombstones
+        mask = self._capacity - 1
+        hole = slot
+        slot = (slot + 1) & mask
+        while True:
+            key, location = SLOT.unpack_from(self._slots, slot * SLOT.size)
+            if location == 0:
+                break
+            home = int.from_bytes(key[:8], 'little') & mask
+            if (slot - home) & mask >= (slot - hole) & mask:
+                self._slots[hole * SLOT.size:(hole + 1) * SLOT.size] = self._slots[slot * SLOT.size:(slot + 1) * SLOT.size]
+                hole = slot
+            slot = (slot + 1) & mask
+        SLOT.pack_into(self._slots, hole * SLOT.size, bytes(16), 0)
+        self._used -= 1
+
+    def mark_pending(self, pub_key):
+        # Returns False if the voter already has a vote pending or committed
+        key = voter_key(pub_key)
+        with self._lock:
+            if self._find(key)[1]:
+                return False
+            self._store(key, LOCATION_PENDING)
+            return True
+
+    def mark_committed(self, pub_key, block_index):
+        # The earliest block wins, a later duplicate never hides it
+        key = voter_key(pub_key)
+        with self._lock:
+            location = self._find(key)[1]
+            if location < 2 or location > block_index + 2:
+                self._store(key, block_index + 2)
+
+    def unmark_pending(self, pub_key):
+        key = voter_key(pub_key)
+        with self._lock:
+            slot, location = self._find(key)
+            if location == LOCATION_PENDING:
+                self._delete(slot)
+
+    def unmark_committed(self, pub_key, block_index):
+        key = voter_key(pub_key)
+        with self._lock:
+            slot, location = self._find(key)
+            if location == block_index + 2:
+                self._delete(slot)
+
+    def snapshot(self, height, tip):
+        # Snapshot of the table for the chain up to height, whose last block
+        # is tip. Only copies the table, write() puts it on disk.
+        with self._lock:
+            return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, height, bytes.fromhex(tip), self._capacity, self._used) + self._slots
+
+    @staticmethod
+    def write(path, snapshot):
+        with open(path + ".tmp", "wb") as f:
+            f.write(snapshot)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        # Returns (index, height, tip). Pending entries belonged to a mempool
+        # that is gone, so they are dropped.
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, height, tip, capacity, used = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or len(data) != SNAPSHOT_HEADER.size + capacity * SLOT.size:
+            raise ValueError("%s is not a spent index snapshot" % path)
+        index = cls(capacity)
+        index._slots = bytearray(data[SNAPSHOT_HEADER.size:])
+        index._used = used
+        locations = np.frombuffer(data, dtype='<u8', offset=SNAPSHOT_HEADER.size).reshape(-1, SLOT.size // 8)[:, -1]
+        pending = [bytes(index._slots[slot * SLOT.size:slot * SLOT.size + 16])
+                   for slot in np.flatnonzero(locations == LOCATION_PENDING).tolist()]
+        for key in pending:
+            slot, location = index._find(key)
+            if location == LOCATION_PENDING:
+                index._delete(slot)
+        return index, height, tip.hex()
@@ -0,0 +1,169 @@
+import contextvars
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Trace context for gossip. Every traced request or background step is a
+# span; its trace id and span id travel to peers in X-Trace-Id/X-Span-Id
+# headers, so the receiving node's span records which hop it came from.
+# Each node appends its finished spans to a JSONL file, and
+#   python tracing.py merge node1/spans.jsonl node2/spans.jsonl [--trace <id>]
+# prints them as one timeline per trace.
+
+TRACE_HEADER = "X-Trace-Id"
+SPAN_HEADER = "X-Span-Id"
+
+_current = contextvars.ContextVar("span", default=None)
+
+
+def _new_id():
+    return uuid.uuid4().hex[:16]
+
+
+class SpanLog:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def write(self, span):
+        line = json.dumps(span)
+        with self._lock:
+            self._file.write(line + "\n")
+
+
+class Tracer:
+    # sample_rate is the share of new traces this node starts; requests that
+    # arrive with a trace id are always followed. Without a log, or at rate 0
+    # with no incoming traces, nothing is recorded.
+
+    def __init__(self, node, log=None, sample_rate=0.0):
+        self.node = node
+        self.log = log
+        self.sample_rate = sample_rate
+
+    def _start(self, name, trace_id, parent_id, attributes):
+        span = {"trace_id": trace_id, "span_id": _new_id(), "parent_id": parent_id,
+                "node": self.node, "name": name, "start": time.time(), "attributes": attributes}
+        span["_clock"] = time.perf_counter()
+        return span
+
+    def _finish(self, span, **attributes):
+        span["duration"] = time.perf_counter() - span.pop("_clock")
+        span["attributes"].update(attributes)
+        if self.log is not None:
+            self.log.write(span)
+
+    def _sampled(self):
+        return self.log is not None and random.random() < self.sample_rate
+
+    def start_request(self, name, headers, root=False):
+        # Opens the server span for an incoming request and returns a token for
+        # finish_request. Untraced requests only start a trace with root=True.
+        trace_id = headers.get(TRACE_HEADER)
+        if trace_id is None:
+            if not root or not self._sampled():
+                return None
+            trace_id = _new_id()
+        span = self._start(name, trace_id, headers.get(SPAN_HEADER), {"kind": "server"})
+        return span, _current.set(span)
+
+    def finish_request(self, token, **attributes):
+        if token is None:
+            return
+        span, context_token = token
+        _current.reset(context_token)
+        self._finish(span, **attributes)
+
+    @contextmanager
+    def span(self, name, root=False, parent=None, **attributes):
+        # Child of parent or of the current span; with root=True a sampled new
+        # trace is started when there is neither. Yields the span, or None
+        # when untraced.
+        parent = parent or _current.get()
+        if parent is None and (not root or not self._sampled()):
+            yield None
+            return
+        span = self._start(name, parent["trace_id"] if parent else _new_id(),
+                           parent["span_id"] if parent else None, attributes)
+        context_token = _current.set(span)
+        try:
+            yield span
+        finally:
+            _current.reset(context_token)
+            self._finish(span)
+
+
+def current():
+    return _current.get()
+
+
+def headers(span=None):
+    # Headers that make the receiving node's span a child of span, or of the current one
+    span = span or _current.get()
+    if span is None:
+        return {}
+    return {TRACE_HEADER: span["trace_id"], SPAN_HEADER: span["span_id"]}
+
+
+def bind(fn):
+    # Carries the caller's trace context into another thread; bind once per task
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def load_spans(paths, trace_id=None):
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    span = json.loads(line)
+                    if trace_id is None or span["trace_id"] == trace_id:
+                        spans.append(span)
+    return spans
+
+
+def timeline(spans):
+    # Spans grouped by trace, each trace as a tree ordered by start time.
+    # Offsets are from the start of the trace, so node clocks need to agree.
+    traces = {}
+    for span in spans:
+        traces.setdefault(span["trace_id"], []).append(span)
+    lines = []
+    for trace_id, trace in sorted(traces.items(), key=lambda item: min(span["start"] for span in item[1])):
+        trace.sort(key=lambda span: span["start"])
+        origin = trace[0]["start"]
+        ids = {span["span_id"] for span in trace}
+        children = {}
+        for span in trace:
+            parent = span["parent_id"] if span["parent_id"] in ids else None
+            children.setdefault(parent, []).append(span)
+        lines.append("trace %s  %d spans  %.1f ms" % (trace_id, len(trace),
+                     (max(span["start"] + span["duration"] for span in trace) - origin) * 1000))
+
+        def walk(parent, depth):
+            for span in children.get(parent, []):
+                attributes = " ".join("%s=%s" % item for item in sorted(span["attributes"].items()))
+                lines.append("  %9.2f ms %9.2f ms  %s%-22s %s  %s" % ((span["start"] - origin) * 1000, span["duration"] * 1000,
+                                                                       "  " * depth, span["node"], span["name"], attributes))
+                walk(span["span_id"], depth + 1)
+        walk(None, 0)
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    # Usage: python tracing.py merge <spans.jsonl>... [--trace <trace_id>]
+    args = sys.argv[2:]
+    trace_id = None
+    if "--trace" in args:
+        position = args.index("--trace")
+        trace_id = args[position + 1]
+        del args[position:position + 2]
+    print(timeline(load_spans(args, trace_id)))
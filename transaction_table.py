@@ -0,0 +1,140 @@
+import bisect
+import sys
+from array import array
+from collections.abc import Mapping
+
+# Read-only transaction map for sealed blocks, stored as columns instead of
+# one dict of four strings per vote: ids sorted for bisect lookups, keys and
+# signatures as fixed-width raw bytes in one buffer each, timestamps in a
+# float array and candidate names interned. The per-vote dicts the JSON
+# endpoints expect are rebuilt only when a vote is read.
+
+FIELDS = {"pub_key", "vote", "timestamp", "sign"}
+
+
+def _raw(hex_string, width):
+    raw = bytes.fromhex(hex_string)
+    if len(raw) != width or raw.hex() != hex_string:
+        raise ValueError("Only fixed-width lowercase hex can be packed")
+    return raw
+
+
+class TransactionTable(Mapping):
+    __slots__ = ('_ids', '_votes', '_timestamps', '_pub_keys', '_signs', '_key_width', '_sign_width')
+
+    @classmethod
+    def pack(cls, transactions):
+        # Raises ValueError for any vote the columns cannot reproduce exactly;
+        # callers keep the plain dict then
+        if isinstance(transactions, cls):
+            return transactions
+        table = cls()
+        ids = sorted(transactions)
+        first = transactions[ids[0]] if ids else None
+        key_width = len(first["pub_key"]) // 2 if first else 0
+        sign_width = len(first["sign"]) // 2 if first else 0
+        pub_keys, signs, votes = [], [], []
+        timestamps = array('d')
+        try:
+            for transaction_id in ids:
+                transaction = transactions[transaction_id]
+                if type(transaction_id) is not str or set(transaction) != FIELDS:
+                    raise ValueError("Unexpected transaction fields")
+                if type(transaction["timestamp"]) is not float or type(transaction["vote"]) is not str:
+                    raise ValueError("Unexpected field types")
+                pub_keys.append(_raw(transaction["pub_key"], key_width))
+                signs.append(_raw(transaction["sign"], sign_width))
+                votes.append(sys.intern(transaction["vote"]))
+                timestamps.append(transaction["timestamp"])
+        except (TypeError, AttributeError):
+            raise ValueError("Unexpected field types")
+        table._ids = tuple(ids)
+        table._votes = tuple(votes)
+        table._timestamps = timestamps
+        table._pub_keys = b''.join(pub_keys)
+        table._signs = b''.join(signs)
+        table._key_width = key_width
+        table._sign_width = sign_width
+        return table
+
+    def _position(self, transaction_id):
+        position = bisect.bisect_left(self._ids, transaction_id)
+        if position < len(self._ids) and self._ids[position] == transaction_id:
+            return position
+        return None
+
+    def _transaction(self, position):
+        key_width, sign_width = self._key_width, self._sign_width
+        return {
+                "pub_key" : self._pub_keys[position * key_width:(position + 1) * key_width].hex(),
+                "vote" : self._votes[position],
+                "timestamp" : self._timestamps[position],
+                "sign" : self._signs[position * sign_width:(position + 1) * sign_width].hex()
+            }
+
+    def __getitem__(self, transaction_id):
+        position = self._position(transaction_id) if isinstance(transaction_id, str) else None
+        if position is None:
+            raise KeyError(transaction_id)
+        return self._transaction(position)
+
+    def __contains__(self, transaction_id):
+        return isinstance(transaction_id, str) and self._position(transaction_id) is not None
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def items(self):
+        return ((transaction_id, self._transaction(position)) for position, transaction_id in enumerate(self._ids))
+
+    def values(self):
+        return (self._transaction(position) for position in range(len(self._ids)))
+
+    def votes(self):
+        # Candidate per vote, without building the transaction dicts
+        return self._votes
+
+    def timestamps(self):
+        return self._timestamps
+
+    def pub_keys(self):
+        width = self._key_width
+        if not width:
+            return iter(())
+        return (self._pub_keys[offset:offset + width].hex() for offset in range(0, len(self._pub_keys), width))
+
+    def packed_pub_keys(self):
+        # Every key's raw bytes back to back, and the width of one key
+        return self._pub_keys, self._key_width
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+def vote_column(transactions):
+    # Candidate per vote for a table or a plain transaction dict
+    if isinstance(transactions, TransactionTable):
+        return transactions.votes()
+    return [transaction["vote"] for transaction in transactions.values()]
+
+
+def pub_key_column(transactions):
+    if isinstance(transactions, TransactionTable):
+        return transactions.pub_keys()
+    return [transaction["pub_key"] for transaction in transactions.values()]
+
+
+def timestamp_column(transactions):
+    if isinstance(transactions, TransactionTable):
+        return transactions.timestamps()
+    return [transaction["timestamp"] for transaction in transactions.values()]
+
+
+def compact(transactions):
+    try:
+        return TransactionTable.pack(transactions)
+    except ValueError:
+        return transactions
@@ -1,6 +1,20 @@
+import os
 import json
 import hashlib
-from ecdsa import SigningKey, VerifyingKey
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from ecdsa import SigningKey, VerifyingKey, NIST384p, BadSignatureError
+from ecdsa.errors import MalformedPointError
+import merkle
+from metrics import crypto_seconds
+
+VERIFY_WORKERS = int(os.environ.get("VOTE_VERIFY_WORKERS", os.cpu_count() or 1))
+PARALLEL_VERIFY_THRESHOLD = 64
+PARALLEL_BLOCK_THRESHOLD = 8
+KEY_CACHE_SIZE = int(os.environ.get("VOTE_KEY_CACHE_SIZE", 10000))
+_executors = {}
+_executors_lock = threading.Lock()
 
 with open("signing_key_block.pem", "rb") as f:
     sk_block = f.read()
@@ -27,50 +41,187 @@ with open("verifying_key_block.pem", "rb") as f:
 #     return sk_txn.sign(encoded_txn).hex()
 
 
+class KeyCache:
+    # Bounded LRU of parsed voter keys. Every process (including the verify
+    # workers) keeps its own cache. Keys are not precomputed: a voter's key
+    # is checked only a few times, too few to pay back building the tables.
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pub_key):
+        with self._lock:
+            key = self._keys.get(pub_key)
+            if key is not None:
+                self._keys.move_to_end(pub_key)
+                self.hits += 1
+                return key
+            self.misses += 1
+
+        # Parse outside the lock, it is the expensive part
+        key = parse_verifying_key(pub_key)
+        with self._lock:
+            self._keys[pub_key] = key
+            self._keys.move_to_end(pub_key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+        return key
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._keys), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def parse_verifying_key(pub_key):
+    return VerifyingKey.from_string(bytes.fromhex(pub_key), curve=NIST384p)
+
+
+key_cache = KeyCache(KEY_CACHE_SIZE)
+
+
+@crypto_seconds.timed("verify_transaction")
 def verify_transaction(transaction):
-    pub_key = transaction["public_key"]
-    msg = transaction["vote"]
-    sign = transaction["sign"]
-    # txn = {
-    #         "pub_key" : transaction["pub_key"],
-    #         "vote" : transaction["vote"].
-    #         "sign" : transaction["sign"]
-    #     }
+    try:
+        pub_key = key_cache.get(transaction["pub_key"])
+        sign = bytes.fromhex(transaction["sign"])
+        return pub_key.verify(sign, transaction["vote"].encode())
+    except (BadSignatureError, MalformedPointError, ValueError):
+        return False
+
+
+def _check_chunk(check, start, items):
+    return [start + i for i, item in enumerate(items) if not check(item)]
+
+
+def _get_executor(workers):
+    with _executors_lock:
+        if workers not in _executors:
+            _executors[workers] = ProcessPoolExecutor(max_workers=workers)
+        return _executors[workers]
+
+
+def start_verify_pool(workers=None):
+    # Forks the verification workers up front. Call it from the main thread
+    # before serving: left to the first batch, the fork would happen on a
+    # request thread and the children could inherit locks other threads hold.
+    workers = workers or VERIFY_WORKERS
+    if workers > 1:
+        # The first task makes the pool fork all of its workers
+        _get_executor(workers).submit(int).result()
+
+
+def _check_batch(check, items, workers, threshold):
+    # Returns the indices of the items that failed the check.
+    items = list(items)
+    workers = workers or VERIFY_WORKERS
+    if workers == 1 or len(items) < threshold:
+        return _check_chunk(check, 0, items)
+
+    # A few chunks per worker keeps the pool busy when some chunks verify slower than others
+    chunk_size = -(-len(items) // (workers * 4))
+    executor = _get_executor(workers)
+    futures = [executor.submit(_check_chunk, check, start, items[start:start + chunk_size])
+               for start in range(0, len(items), chunk_size)]
+    failed = []
+    for future in futures:
+        failed.extend(future.result())
+    return failed
+
 
-    # sign = bytes.fromhex(transaction["sign"])
-    # encoded_txn = json.dumps(txn, sort_keys=True).encode()
-    return public_key.verify(sign, msg)
+@crypto_seconds.timed("verify_transactions")
+def verify_transactions(transactions, workers=None):
+    return _check_batch(verify_transaction, transactions, workers, PARALLEL_VERIFY_THRESHOLD)
 
 
+@crypto_seconds.timed("verify_blocks")
+def verify_blocks(blocks, workers=None):
+    # Full signature and Merkle root checks for block dicts; the hash links
+    # between them are left to the caller.
+    return _check_batch(is_valid_block, blocks, workers, PARALLEL_BLOCK_THRESHOLD)
+
+
+@crypto_seconds.timed("encrypt")
 def encrypt(transaction):
     encoded_transaction = json.dumps(transaction, sort_keys=True).encode()
     return hashlib.sha256(encoded_transaction).hexdigest()
 
 
-def is_valid_block(block):
-    blk = {
-        "index": block["index"],
-        "transactions": block["transactions"],
-        "timestamp": block["timestamp"],
-        "previous_hash": block["previous_hash"]
+def block_header(index, timestamp, previous_hash, merkle_root):
+    return {
+        "index": index,
+        "timestamp": timestamp,
+        "previous_hash": previous_hash,
+        "merkle_root": merkle_root
     }
-    sign = bytes.fromhex(block["proof_of_verification"])
-    encoded_block = json.dumps(blk, sort_keys=True).encode()
-    return vk_block.verify(sign, encoded_block)
+
+
+@crypto_seconds.timed("hash_header")
+def hash_header(header):
+    encoded_header = json.dumps(header, sort_keys=True).encode()
+    return hashlib.sha256(encoded_header).hexdigest()
+
+
+@crypto_seconds.timed("sign_header")
+def sign_header(header):
+    encoded_header = json.dumps(header, sort_keys=True).encode()
+    return sk_block.sign(encoded_header).hex()
+
+
+@crypto_seconds.timed("is_valid_header")
+def is_valid_header(block):
+    # Constant-time check: the signature and hash only cover the header
+    header = block_header(block["index"], block["timestamp"], block["previous_hash"], block["merkle_root"])
+    if "hash" in block and block["hash"] != hash_header(header):
+        return False
+    encoded_header = json.dumps(header, sort_keys=True).encode()
+    try:
+        sign = bytes.fromhex(block["proof_of_verification"])
+        return vk_block.verify(sign, encoded_header)
+    except (BadSignatureError, ValueError, TypeError):
+        return False
+
+
+def is_consistent_block(block):
+    # Hash and Merkle root checks only, for blocks covered by a trusted checkpoint
+    header = block_header(block["index"], block["timestamp"], block["previous_hash"], block.get("merkle_root"))
+    if block.get("hash") != hash_header(header):
+        return False
+    return merkle.merkle_root(block["transactions"]) == block["merkle_root"]
+
+
+@crypto_seconds.timed("is_valid_block")
+def is_valid_block(block):
+    if "merkle_root" not in block or not is_valid_header(block):
+        return False
+    return merkle.merkle_root(block["transactions"]) == block["merkle_root"]
 
 
 def sign_block(index, transactions, timestamp, previous_hash):
-    for transaction in transactions:
-        if not verify_transaction(transactions[transaction]):
-            return False
+    if verify_transactions(transactions.values()):
+        return False
+    return sign_header(block_header(index, timestamp, previous_hash, merkle.merkle_root(transactions)))
+
+
+def sign_checkpoint(index, block_hash):
+    encoded_checkpoint = json.dumps({"index": index, "hash": block_hash}, sort_keys=True).encode()
+    return {"index": index, "hash": block_hash, "sign": sk_block.sign(encoded_checkpoint).hex()}
 
-    block = {
-        "index": index,
-        "transactions": transactions,
-        "timestamp": timestamp,
-        "previous_hash": previous_hash
-    }
 
-    encoded_block = json.dumps(block, sort_keys=True).encode()
-    sign = sk_block.sign(encoded_block).hex()
-    return sign
+def is_valid_checkpoint(checkpoint):
+    try:
+        encoded_checkpoint = json.dumps({"index": checkpoint["index"], "hash": checkpoint["hash"]},
+                                        sort_keys=True).encode()
+        return vk_block.verify(bytes.fromhex(checkpoint["sign"]), encoded_checkpoint)
+    except (BadSignatureError, KeyError, ValueError, TypeError):
+        return False
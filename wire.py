@@ -0,0 +1,280 @@
+import struct
+import zlib
+
+# Binary encoding for blocks, chain pages and transaction maps. Hex fields
+# (keys, signatures, hashes) travel as raw bytes and the block header has a
+# fixed layout. Anything the format cannot reproduce exactly raises
+# ValueError, and callers fall back to JSON.
+
+MIME = "application/x-vote-wire"
+MAGIC = b'VW'
+VERSION = 1
+FLAG_COMPRESSED = 1
+COMPRESS_MIN = 1024
+# Largest body a payload may inflate to, unless the caller bounds what it expects
+MAX_SIZE = 32 * 1024 * 1024
+# Allowance for one encoded vote, for callers bounding a payload by vote count
+MAX_VOTE_SIZE = 1024
+
+KIND_BLOCK = 1
+KIND_CHAIN = 2
+KIND_TRANSACTIONS = 3
+
+PREAMBLE = struct.Struct('<2sBBB')          # magic, version, flags, kind
+BLOCK_INDEX = struct.Struct('<Q')
+CHAIN_PAGE = struct.Struct('<QQI')          # chain length, first index, block count
+U8 = struct.Struct('<B')
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+F64 = struct.Struct('<d')
+I64 = struct.Struct('<q')
+
+VALUE_FLOAT = 0
+VALUE_INT = 1
+VALUE_STR = 2
+
+TRANSACTION_FIELDS = {"pub_key", "vote", "timestamp", "sign"}
+BLOCK_FIELDS = {"index", "transactions", "proof_of_verification", "timestamp", "previous_hash", "merkle_root", "hash"}
+
+
+def _raw(hex_string):
+    raw = bytes.fromhex(hex_string)
+    if raw.hex() != hex_string:
+        raise ValueError("Only lowercase hex survives a round trip")
+    return raw
+
+
+class _Writer:
+    def __init__(self):
+        self.parts = []
+
+    def pack(self, fmt, *values):
+        self.parts.append(fmt.pack(*values))
+
+    def short_bytes(self, data):
+        self.pack(U8, len(data))
+        self.parts.append(data)
+
+    def bytes(self, data):
+        self.pack(U16, len(data))
+        self.parts.append(data)
+
+    def text(self, value):
+        if not isinstance(value, str):
+            raise ValueError("Expected a string")
+        self.bytes(value.encode())
+
+    def value(self, value):
+        # Timestamps come from clients, keep their JSON type exactly
+        if isinstance(value, float):
+            self.pack(U8, VALUE_FLOAT)
+            self.pack(F64, value)
+        elif isinstance(value, int) and not isinstance(value, bool):
+            self.pack(U8, VALUE_INT)
+            self.pack(I64, value)
+        elif isinstance(value, str):
+            self.pack(U8, VALUE_STR)
+            self.text(value)
+        else:
+            raise ValueError("Unsupported value type")
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def take(self, length):
+        if self.offset + length > len(self.data):
+            raise ValueError("Truncated payload")
+        chunk = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return chunk
+
+    def short_bytes(self):
+        return self.take(self.unpack(U8)[0])
+
+    def bytes(self):
+        return self.take(self.unpack(U16)[0])
+
+    def text(self):
+        return self.bytes().decode()
+
+    def value(self):
+        kind = self.unpack(U8)[0]
+        if kind == VALUE_FLOAT:
+            return self.unpack(F64)[0]
+        if kind == VALUE_INT:
+            return self.unpack(I64)[0]
+        if kind == VALUE_STR:
+            return self.text()
+        raise ValueError("Unknown value type")
+
+
+def _write_transactions(writer, transactions):
+    writer.pack(U32, len(transactions))
+    for transaction_id, transaction in transactions.items():
+        if set(transaction) != TRANSACTION_FIELDS:
+            raise ValueError("Unexpected transaction fields")
+        writer.text(transaction_id)
+        writer.short_bytes(_raw(transaction["pub_key"]))
+        writer.text(transaction["vote"])
+        writer.value(transaction["timestamp"])
+        writer.short_bytes(_raw(transaction["sign"]))
+
+
+def _read_transactions(reader):
+    # Hot path when decoding large blocks, so the reader calls are inlined
+    data = reader.data
+    offset = reader.offset
+    unpack_u16, unpack_u32 = U16.unpack_from, U32.unpack_from
+    transactions = {}
+    count = unpack_u32(data, offset)[0]
+    offset += U32.size
+    for _ in range(count):
+        length = unpack_u16(data, offset)[0]
+        transaction_id = data[offset + 2:offset + 2 + length].decode()
+        offset += 2 + length
+        length = data[offset]
+        pub_key = data[offset + 1:offset + 1 + length].hex()
+        offset += 1 + length
+        length = unpack_u16(data, offset)[0]
+        vote = data[offset + 2:offset + 2 + length].decode()
+        offset += 2 + length
+        reader.offset = offset
+        timestamp = reader.value()
+        offset = reader.offset
+        length = data[offset]
+        sign = data[offset + 1:offset + 1 + length].hex()
+        offset += 1 + length
+        if offset > len(data):
+            raise ValueError("Truncated payload")
+        transactions[transaction_id] = {
+                "pub_key" : pub_key,
+                "vote" : vote,
+                "timestamp" : timestamp,
+                "sign" : sign
+            }
+    reader.offset = offset
+    return transactions
+
+
+def _write_block(writer, block):
+    if set(block) != BLOCK_FIELDS or isinstance(block["index"], bool):
+        raise ValueError("Unexpected block fields")
+    writer.pack(BLOCK_INDEX, block["index"])
+    writer.value(block["timestamp"])
+    # The genesis block links to the integer 0 rather than a hash
+    previous_hash = block["previous_hash"]
+    if type(previous_hash) is int and previous_hash == 0:
+        writer.short_bytes(b'')
+    elif previous_hash:
+        writer.short_bytes(_raw(previous_hash))
+    else:
+        raise ValueError("Unsupported previous_hash")
+    writer.short_bytes(_raw(block["merkle_root"]))
+    writer.short_bytes(_raw(block["hash"]))
+    writer.short_bytes(_raw(block["proof_of_verification"]))
+    _write_transactions(writer, block["transactions"])
+
+
+def _read_block(reader):
+    index = reader.unpack(BLOCK_INDEX)[0]
+    timestamp = reader.value()
+    previous_hash = reader.short_bytes()
+    merkle_root = reader.short_bytes().hex()
+    block_hash = reader.short_bytes().hex()
+    proof_of_verification = reader.short_bytes().hex()
+    return {
+        "index": index,
+        "transactions": _read_transactions(reader),
+        "proof_of_verification": proof_of_verification,
+        "timestamp": timestamp,
+        "previous_hash": previous_hash.hex() if previous_hash else 0,
+        "merkle_root": merkle_root,
+        "hash": block_hash
+    }
+
+
+def _frame(kind, body, compress):
+    flags = 0
+    if compress is None:
+        compress = len(body) >= COMPRESS_MIN
+    if compress:
+        body = zlib.compress(body)
+        flags |= FLAG_COMPRESSED
+    return PREAMBLE.pack(MAGIC, VERSION, flags, kind) + body
+
+
+def _encode(kind, write, compress):
+    writer = _Writer()
+    try:
+        write(writer)
+    except (struct.error, TypeError) as e:
+        # Wrongly typed fields, or numbers and lengths that do not fit the layout
+        raise ValueError(str(e))
+    return _frame(kind, writer.getvalue(), compress)
+
+
+def encode_block(block, compress=None):
+    return _encode(KIND_BLOCK, lambda writer: _write_block(writer, block), compress)
+
+
+def encode_chain_page(length, start, blocks, compress=None):
+    def write(writer):
+        writer.pack(CHAIN_PAGE, length, start, len(blocks))
+        for block in blocks:
+            _write_block(writer, block)
+    return _encode(KIND_CHAIN, write, compress)
+
+
+def encode_transactions(transactions, compress=None):
+    return _encode(KIND_TRANSACTIONS, lambda writer: _write_transactions(writer, transactions), compress)
+
+
+def decode(payload, max_size=MAX_SIZE):
+    # Returns a block dict, a {"length", "from", "chain"} page or a transaction
+    # map, shaped exactly like the JSON the same endpoint would have sent
+    try:
+        magic, version, flags, kind = PREAMBLE.unpack_from(payload, 0)
+    except struct.error:
+        raise ValueError("Truncated payload")
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a wire payload")
+    body = payload[PREAMBLE.size:]
+    if flags & FLAG_COMPRESSED:
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(body, max_size)
+        except zlib.error:
+            raise ValueError("Corrupt compressed payload")
+        if decompressor.unconsumed_tail:
+            raise ValueError("Payload too large")
+    reader = _Reader(body)
+    try:
+        if kind == KIND_BLOCK:
+            return _read_block(reader)
+        if kind == KIND_TRANSACTIONS:
+            return _read_transactions(reader)
+        if kind == KIND_CHAIN:
+            length, start, count = reader.unpack(CHAIN_PAGE)
+            return {"length": length, "from": start, "chain": [_read_block(reader) for _ in range(count)]}
+    except (struct.error, IndexError):
+        # The inlined transaction reader indexes past the end of a short body
+        raise ValueError("Truncated payload")
+    raise ValueError("Unknown payload kind")
+
+
+def decode_response(response, max_size=MAX_SIZE):
+    # Decodes a requests response whichever format the server picked
+    if response.headers.get("Content-Type", "").startswith(MIME):
+        return decode(response.content, max_size)
+    return response.json()